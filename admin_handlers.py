@@ -4,6 +4,7 @@ import os
 import logging
 import asyncio
 from functools import wraps
+from typing import AsyncIterator
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -19,7 +20,11 @@ from telegram.error import BadRequest, Forbidden, RetryAfter # Importar RetryAft
 
 import db_supabase as db
 import scheduler
-from utils import send_access_links, format_date_br
+import group_registry
+import membership
+import expiry_timers
+import rate_limiter
+from utils import send_access_links, format_date_br, run_bounded_stream
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +36,9 @@ ADMIN_IDS = [int(admin_id.strip()) for admin_id in ADMIN_IDS_STR.split(',')] if
 PRODUCT_ID_LIFETIME = int(os.getenv("PRODUCT_ID_LIFETIME", 0))
 PRODUCT_ID_MONTHLY = int(os.getenv("PRODUCT_ID_MONTHLY", 0))
 
+# --- Envios simultâneos nos broadcasts (o ritmo real é definido pelo rate limiter) ---
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+
 # --- Estados da ConversationHandler (MAIS ESTADOS ADICIONADOS) ---
 (
     SELECTING_ACTION,
@@ -173,6 +181,7 @@ async def grant_access_select_plan(update: Update, context: ContextTypes.DEFAULT
     await query.edit_message_text(text="Processando concessão...")
     new_sub = await db.create_manual_subscription(db_user_id, product_id, f"manual_grant_by_admin_{admin_id}")
     if new_sub:
+        expiry_timers.schedule({**new_sub, 'user': {'telegram_user_id': telegram_user_id}})
         await send_access_links(context.bot, telegram_user_id, new_sub.get('mp_payment_id', 'manual'))
         await query.edit_message_text(text=f"✅ Acesso concedido com sucesso para o usuário {telegram_user_id}! Os links foram enviados.")
         try:
@@ -225,8 +234,12 @@ async def revoke_access_confirm(update: Update, context: ContextTypes.DEFAULT_TY
     admin_id = update.effective_user.id
     success = await db.revoke_subscription(db_user_id, f"revoked_by_admin_{admin_id}")
     if success:
-        removed_count = await scheduler.kick_user_from_all_groups(telegram_user_id, context.bot)
-        await query.edit_message_text(f"✅ Acesso revogado com sucesso. O usuário foi removido de {removed_count} grupos.")
+        expiry_timers.cancel_for_user(db_user_id)
+        kick_result = await scheduler.kick_users_from_all_groups([telegram_user_id], context.bot)
+        text = f"✅ Acesso revogado com sucesso. O usuário foi removido de {kick_result['removed']} grupos."
+        if kick_result['failed']:
+            text += f"\n⚠️ Falha ao remover de {kick_result['failed']} grupo(s). Verifique as permissões do bot."
+        await query.edit_message_text(text)
         try:
             await context.bot.send_message(telegram_user_id, "Seu acesso foi revogado por um administrador.")
         except Exception:
@@ -265,38 +278,32 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not message_to_send:
         await query.edit_message_text("Erro: Mensagem não encontrada. Operação cancelada.")
         return ConversationHandler.END
-    await query.edit_message_text("Buscando usuários... O envio começará em breve.")
-    user_ids = await db.get_all_active_tg_user_ids()
-    total_users = len(user_ids)
-    await query.edit_message_text(f"Iniciando envio para {total_users} usuários... Isso pode levar tempo.")
-    asyncio.create_task(
-        run_broadcast(context, message_to_send, user_ids, query.message.chat_id, query.message.message_id)
-    )
+    await query.edit_message_text("Iniciando envio para os usuários ativos... Isso pode levar tempo.")
+    # Os IDs são lidos em páginas enquanto o envio acontece
+    user_ids = db.iter_active_tg_user_ids()
+    with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+        asyncio.create_task(
+            run_broadcast(context, message_to_send, user_ids, query.message.chat_id, query.message.message_id)
+        )
     context.user_data.clear()
     return ConversationHandler.END
 
-async def run_broadcast(context: ContextTypes.DEFAULT_TYPE, message_to_send, user_ids, admin_chat_id, admin_message_id):
-    sent_count, failed_count, total_users = 0, 0, len(user_ids)
-    for i, user_id in enumerate(user_ids):
+async def run_broadcast(context: ContextTypes.DEFAULT_TYPE, message_to_send, user_ids: AsyncIterator[int], admin_chat_id, admin_message_id):
+    # O ritmo de envio é controlado pelo rate limiter do bot (prioridade de envio em massa)
+    sent_count, failed_count, processed = 0, 0, 0
+
+    async def send_one(user_id: int):
+        nonlocal sent_count, failed_count, processed
         try:
             await context.bot.copy_message(chat_id=user_id, from_chat_id=message_to_send.chat_id, message_id=message_to_send.message_id)
             sent_count += 1
-            if i % 25 == 0 and i > 0:
-                await context.bot.edit_message_text(chat_id=admin_chat_id, message_id=admin_message_id, text=f"Progresso: {i}/{total_users} enviados... Pausando por 5 segundos para evitar limites.")
-                await asyncio.sleep(5)
-            else:
-                await asyncio.sleep(1)
-        except RetryAfter as e:
-            logger.warning(f"Limite de flood atingido. Pausando por {e.retry_after} segundos.")
-            await context.bot.edit_message_text(chat_id=admin_chat_id, message_id=admin_message_id, text=f"Limite da API atingido. Pausando por {e.retry_after}s...")
-            await asyncio.sleep(e.retry_after)
-            try:
-                await context.bot.copy_message(chat_id=user_id, from_chat_id=message_to_send.chat_id, message_id=message_to_send.message_id)
-                sent_count += 1
-            except (BadRequest, Forbidden):
-                failed_count += 1
-        except (BadRequest, Forbidden):
+        except (BadRequest, Forbidden, RetryAfter):
             failed_count += 1
+        processed += 1
+        if processed % 25 == 0:
+            await context.bot.edit_message_text(chat_id=admin_chat_id, message_id=admin_message_id, text=f"Progresso: {processed} processados...")
+
+    await run_bounded_stream(user_ids, send_one, BROADCAST_CONCURRENCY)
     final_text = f"📢 Envio concluído!\n\n- Mensagens enviadas: {sent_count}\n- Falhas (usuários que bloquearam o bot): {failed_count}"
     await context.bot.edit_message_text(chat_id=admin_chat_id, message_id=admin_message_id, text=final_text)
 
@@ -308,7 +315,7 @@ async def grant_new_group_start(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     await query.edit_message_text("Buscando grupos cadastrados...")
 
-    groups = await db.get_all_groups_with_names()
+    groups = await group_registry.get_groups()
     if not groups:
         await query.edit_message_text("Nenhum grupo encontrado no banco de dados. Cadastre um grupo primeiro.")
         return ConversationHandler.END
@@ -316,7 +323,7 @@ async def grant_new_group_start(update: Update, context: ContextTypes.DEFAULT_TY
     keyboard = []
     for group in groups:
         # Usamos .get para segurança, caso o nome não esteja definido
-        group_name = group.get('name', f"ID: {group['telegram_chat_id']}")
+        group_name = group.get('title') or f"ID: {group['telegram_chat_id']}"
         keyboard.append([InlineKeyboardButton(group_name, callback_data=f"new_group_select_{group['telegram_chat_id']}")])
 
     keyboard.append([InlineKeyboardButton("⬅️ Voltar", callback_data="admin_back_to_menu")])
@@ -331,12 +338,7 @@ async def grant_new_group_select_group(update: Update, context: ContextTypes.DEF
     chat_id = int(query.data.split('_')[-1])
     context.user_data['new_group_chat_id'] = chat_id
 
-    try:
-        chat = await context.bot.get_chat(chat_id)
-        group_name = chat.title
-    except Exception as e:
-        logger.error(f"Não foi possível obter informações do grupo {chat_id}: {e}")
-        group_name = f"ID {chat_id}"
+    group_name = group_registry.get_title(chat_id) or f"ID {chat_id}"
 
     keyboard = [
         [InlineKeyboardButton("✅ SIM, ENVIAR CONVITES", callback_data="new_group_confirm")],
@@ -359,45 +361,37 @@ async def grant_new_group_confirm(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_text("Erro: ID do grupo não encontrado. Operação cancelada.")
         return ConversationHandler.END
 
-    await query.edit_message_text("Buscando usuários ativos... O envio dos convites começará em breve.")
+    await query.edit_message_text("Iniciando envio de convites para os usuários ativos... Isso pode levar tempo.")
 
-    user_ids = await db.get_all_active_tg_user_ids()
-    total_users = len(user_ids)
+    # Os IDs são lidos em páginas enquanto os convites são enviados
+    user_ids = db.iter_active_tg_user_ids()
 
-    if total_users == 0:
-        await query.edit_message_text("Nenhum usuário com assinatura ativa foi encontrado.")
-        return ConversationHandler.END
-
-    await query.edit_message_text(f"Iniciando envio de convites para {total_users} usuários... Isso pode levar tempo.")
-
-    asyncio.create_task(
-        run_new_group_broadcast(context, chat_id, user_ids, query.message.chat_id, query.message.message_id)
-    )
+    with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+        asyncio.create_task(
+            run_new_group_broadcast(context, chat_id, user_ids, query.message.chat_id, query.message.message_id)
+        )
 
     context.user_data.clear()
     return ConversationHandler.END
 
-async def run_new_group_broadcast(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_ids: list[int], admin_chat_id: int, admin_message_id: int):
+async def run_new_group_broadcast(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_ids: AsyncIterator[int], admin_chat_id: int, admin_message_id: int):
     """Envia um link de convite de um grupo específico para uma lista de usuários."""
     sent_count = 0
     failed_count = 0
     already_member_count = 0
-    total_users = len(user_ids)
+    total_users = 0
 
-    try:
-        chat = await context.bot.get_chat(chat_id)
-        group_name = chat.title
-    except Exception:
-        group_name = f"o novo grupo (ID: {chat_id})"
+    group_name = group_registry.get_title(chat_id) or f"o novo grupo (ID: {chat_id})"
 
 
-    for i, user_id in enumerate(user_ids):
+    async def invite_one(user_id: int):
+        nonlocal sent_count, failed_count, already_member_count, total_users
+        total_users += 1
         try:
-            # 1. VERIFICA SE O USUÁRIO JÁ É MEMBRO
-            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
+            # 1. VERIFICA SE O USUÁRIO JÁ É MEMBRO (índice local; API só se o par for desconhecido)
+            if await membership.is_member(context.bot, chat_id, user_id):
                 already_member_count += 1
-                continue # Pula para o próximo
+                return # Pula para o próximo
 
             # 2. GERA E ENVIA O LINK
             link = await context.bot.create_chat_invite_link(chat_id=chat_id, member_limit=1)
@@ -407,23 +401,22 @@ async def run_new_group_broadcast(context: ContextTypes.DEFAULT_TYPE, chat_id: i
             await context.bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN)
             sent_count += 1
 
-            # 3. LÓGICA DE RATE LIMIT (igual ao broadcast normal)
-            if i % 25 == 0 and i > 0:
+            # 3. PROGRESSO (o ritmo de envio é controlado pelo rate limiter do bot)
+            if total_users % 25 == 0:
                 await context.bot.edit_message_text(
                     chat_id=admin_chat_id, message_id=admin_message_id,
-                    text=f"Progresso: {i}/{total_users}... Pausando por 5s."
+                    text=f"Progresso: {total_users} processados..."
                 )
-                await asyncio.sleep(5)
-            else:
-                await asyncio.sleep(1)
 
-        except (BadRequest, Forbidden):
+        except (BadRequest, Forbidden, RetryAfter):
             failed_count += 1
         except Exception as e:
             # Captura outros erros inesperados sem parar o loop
             logger.error(f"Erro inesperado ao processar usuário {user_id} para o grupo {chat_id}: {e}")
             failed_count += 1
 
+    await run_bounded_stream(user_ids, invite_one, BROADCAST_CONCURRENCY)
+
     final_text = (f"✉️ **Envio de Convites Concluído!**\n\n"
                   f"▫️ **Grupo:** {group_name}\n"
                   f"▫️ **Total de Assinantes:** {total_users}\n"
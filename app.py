@@ -7,20 +7,29 @@ import json
 import uuid
 import base64
 import io
-import asyncio
 import sys
 from datetime import datetime, timedelta, timezone
 
-from quart import Quart, request, abort
+from quart import Quart, request, abort, jsonify
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatInviteLink, User as TelegramUser, BotCommand
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, JobQueue
+from telegram import Chat, Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatInviteLink, User as TelegramUser, BotCommand
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, MessageHandler, filters, ContextTypes, JobQueue
 from telegram.constants import ParseMode
 from telegram.error import BadRequest, Forbidden
 from telegram.request import HTTPXRequest
 
 import db_supabase as db
 import scheduler # Importa nosso novo arquivo
+import group_registry
+import invite_pool
+import membership
+import rate_limiter
+import expiry_timers
+import shards
+import mp_client
+import mp_notifications
+import update_workers
+import outbox
 from admin_handlers import get_admin_conversation_handler
 from utils import format_date_br, send_access_links
 
@@ -58,12 +67,15 @@ if not all([
 
 NOTIFICATION_URL = f"{WEBHOOK_BASE_URL}/webhook/mercadopago"
 TELEGRAM_WEBHOOK_URL = f"{WEBHOOK_BASE_URL}/webhook/telegram"
+# Tempo mínimo de validade restante para reenviar uma cobrança PIX em aberto em vez de criar outra
+PIX_REUSE_MIN_REMAINING_MINUTES = int(os.getenv("PIX_REUSE_MIN_REMAINING_MINUTES", 5))
 TIMEZONE_BR = timezone(timedelta(hours=-3))
 
 # --- INICIALIZAÇÃO DO BOT ---
 request_config = {'connect_timeout': 10.0, 'read_timeout': 20.0}
 httpx_request = HTTPXRequest(**request_config)
-bot_app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(httpx_request).job_queue(JobQueue()).build()
+# Todas as chamadas do bot passam pelo limitador central (limites global/por chat, RetryAfter e prioridades)
+bot_app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(httpx_request).job_queue(JobQueue()).rate_limiter(rate_limiter.TelegramRateLimiter()).build()
 app = Quart(__name__)
 
 
@@ -196,8 +208,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await query.edit_message_text(text="Desculpe, este produto não está mais disponível.")
             return
 
-        await query.edit_message_text(text=f"Gerando sua cobrança PIX para o plano '{product['name']}', aguarde...")
-        payment_data = await create_pix_payment(tg_user, product)
+        # Cobrança ainda em aberto para o mesmo plano: reenvia a mesma, sem chamar o Mercado Pago
+        valid_until = datetime.now(timezone.utc) + timedelta(minutes=PIX_REUSE_MIN_REMAINING_MINUTES)
+        payment_data = await db.get_open_pix_charge(tg_user.id, product_id, valid_until)
+        if payment_data:
+            logger.info(f"[{payment_data['mp_payment_id']}] Reenviando cobrança PIX em aberto para o usuário {tg_user.id}.")
+            await query.edit_message_text(text=f"Você já tem uma cobrança PIX em aberto para o plano '{product['name']}' (válida até {format_date_br(payment_data['expires_at'])}). Reenviando...")
+        else:
+            await query.edit_message_text(text=f"Gerando sua cobrança PIX para o plano '{product['name']}', aguarde...")
+            payment_data = await create_pix_payment(tg_user, product)
 
         if payment_data:
             qr_code_image = base64.b64decode(payment_data['qr_code_base64'])
@@ -237,12 +256,39 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             text=texto,
             parse_mode=ParseMode.MARKDOWN_V2 # Usamos a versão V2
         )
+
+# --- HANDLER DE MUDANÇAS NO STATUS DO BOT EM GRUPOS ---
+
+async def bot_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """O bot foi adicionado/removido de um grupo: força a recarga do registro de grupos."""
+    chat = update.my_chat_member.chat
+    # Chats privados (usuário bloqueou/desbloqueou o bot) não afetam o registro de grupos
+    if chat.type not in (Chat.GROUP, Chat.SUPERGROUP, Chat.CHANNEL):
+        return
+    logger.info(f"Status do bot alterado no chat {chat.id} ({chat.title}): {update.my_chat_member.new_chat_member.status}.")
+    group_registry.set_title(chat.id, chat.title)
+    group_registry.invalidate()
+
+
+async def group_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mantém o índice de membros atualizado e revoga convites do pool assim que são usados."""
+    used_invite_link = await membership.handle_chat_member_update(update.chat_member)
+    if used_invite_link:
+        await invite_pool.mark_consumed(context.bot, update.chat_member.chat.id, used_invite_link)
+
+
+async def chat_title_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Atualiza o cache de títulos quando o título de um grupo é alterado."""
+    chat = update.effective_chat
+    group_registry.set_title(chat.id, update.effective_message.new_chat_title)
+
 # --- LÓGICA DE PAGAMENTO E ACESSO ---
 
 async def create_pix_payment(tg_user: TelegramUser, product: dict) -> dict | None:
-    """Cria uma cobrança PIX no Mercado Pago e uma assinatura pendente no DB."""
-    url = "https://api.mercadopago.com/v1/payments"
-    headers = { "Authorization": f"Bearer {MERCADO_PAGO_ACCESS_TOKEN}", "Content-Type": "application/json", "X-Idempotency-Key": str(uuid.uuid4()) }
+    """
+    Cria uma cobrança PIX no Mercado Pago (com a validade padrão do MP) e uma
+    assinatura pendente no DB com o QR Code, o código e a validade para reenvio.
+    """
     # Adicionamos o product_id na referência externa para saber o que foi comprado
     external_ref = f"user:{tg_user.id};product:{product['id']}"
     payload = {
@@ -254,20 +300,24 @@ async def create_pix_payment(tg_user: TelegramUser, product: dict) -> dict | Non
         "external_reference": external_ref
     }
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload, timeout=10)
-            response.raise_for_status()
-        data = response.json()
+        data = await mp_client.create_payment(payload, idempotency_key=str(uuid.uuid4()))
         mp_payment_id = str(data.get('id'))
+        pix_charge = {
+            'mp_payment_id': mp_payment_id,
+            'qr_code_base64': data['point_of_interaction']['transaction_data']['qr_code_base64'],
+            'pix_copy_paste': data['point_of_interaction']['transaction_data']['qr_code'],
+            # Sem validade informada pelo MP a cobrança não é reutilizada (get_open_pix_charge exige pix_expires_at)
+            'expires_at': data.get('date_of_expiration'),
+        }
 
         db_user = await db.get_or_create_user(tg_user)
         if db_user and db_user.get('id'):
-            await db.create_pending_subscription(db_user['id'], product['id'], mp_payment_id)
+            await db.create_pending_subscription(db_user['id'], product['id'], mp_payment_id, pix_charge)
         else:
             logger.error(f"Não foi possível obter/criar o usuário do DB para {tg_user.id}. A transação não foi registrada.")
             return None
 
-        return { 'qr_code_base64': data['point_of_interaction']['transaction_data']['qr_code_base64'], 'pix_copy_paste': data['point_of_interaction']['transaction_data']['qr_code'] }
+        return pix_charge
     except httpx.HTTPError as e:
         logger.error(f"Erro HTTP ao criar pagamento no Mercado Pago: {e}")
         return None
@@ -276,25 +326,53 @@ async def create_pix_payment(tg_user: TelegramUser, product: dict) -> dict | Non
         return None
 
 
-async def process_approved_payment(payment_id: str):
-    """Processa um pagamento aprovado, ativa a assinatura e agenda o envio dos links."""
-    logger.info(f"[{payment_id}] Iniciando processamento de pagamento aprovado.")
+async def process_approved_payment(payment_id: str) -> bool:
+    """
+    Registra no outbox a ativação de um pagamento aprovado. A ativação e o envio
+    dos links rodam nos workers do outbox, com retentativas, e sobrevivem a um
+    restart. Retorna True quando o trabalho ficou gravado (agora ou antes).
+    """
+    logger.info(f"[{payment_id}] Pagamento aprovado. Enfileirando ativação no outbox.")
+    return await outbox.enqueue('activate_payment', {'payment_id': payment_id}, dedup_key=f"activate:{payment_id}")
+
+
+async def activate_payment_job(bot, payload: dict):
+    """Job do outbox: ativa a assinatura e enfileira o envio dos links de acesso."""
+    payment_id = payload['payment_id']
+    # Esta função retorna os dados da assinatura se for bem sucedida
+    subscription = await db.activate_subscription(payment_id)
+    if subscription is None:
+        # Assinatura não encontrada ou erro no DB: o outbox tenta de novo com backoff
+        raise RuntimeError(f"Não foi possível ativar a assinatura do pagamento {payment_id}.")
+
+    telegram_user_id = subscription.get('user', {}).get('telegram_user_id')
+    if subscription.get('activated'):
+        # Agenda o aviso e a expiração desta assinatura no próprio processo
+        expiry_timers.schedule(subscription)
+    if subscription.get('status') != 'active':
+        logger.warning(f"[{payment_id}] Assinatura não está ativa (status: {subscription.get('status')}). Nenhum link será enviado.")
+        return
+    if not telegram_user_id:
+        logger.error(f"[{payment_id}] CRÍTICO: Assinatura ativada, mas não foi possível encontrar o telegram_user_id associado.")
+        return
+    # Também quando a ativação já tinha ocorrido: se o job caiu antes deste ponto, os links
+    # ainda não foram enfileirados. O dedup_key garante um único envio por pagamento.
+    logger.info(f"[{payment_id}] Assinatura ativa. Enfileirando envio de links para o usuário {telegram_user_id}.")
+    if not await outbox.enqueue('send_access_links', {'telegram_user_id': telegram_user_id, 'payment_id': payment_id}, dedup_key=f"links:{payment_id}"):
+        raise RuntimeError(f"Não foi possível enfileirar os links do pagamento {payment_id}.")
+
 
-    # Ativa a assinatura no banco de dados. Esta função retorna os dados da assinatura se for bem sucedida.
-    activated_subscription = await db.activate_subscription(payment_id)
+async def send_access_links_job(bot, payload: dict):
+    """Job do outbox: envia os links de acesso de um pagamento."""
+    try:
+        await send_access_links(bot, payload['telegram_user_id'], payload['payment_id'])
+    except Forbidden:
+        # O usuário bloqueou o bot: não adianta tentar de novo
+        logger.warning(f"[{payload['payment_id']}] Usuário {payload['telegram_user_id']} bloqueou o bot. Links não enviados.")
 
-    if activated_subscription:
-        # A função `activate_subscription` já retorna o telegram_user_id
-        telegram_user_id = activated_subscription.get('user', {}).get('telegram_user_id')
 
-        if telegram_user_id:
-            logger.info(f"[{payment_id}] Assinatura ativada. Agendando envio de links para o usuário {telegram_user_id}.")
-            # Usamos create_task para não bloquear o webhook
-            asyncio.create_task(send_access_links(bot_app.bot, telegram_user_id, payment_id))
-        else:
-            logger.error(f"[{payment_id}] CRÍTICO: Assinatura ativada, mas não foi possível encontrar o telegram_user_id associado.")
-    else:
-        logger.warning(f"[{payment_id}] A ativação da assinatura falhou ou já estava ativa. Nenhuma ação de envio de link será tomada.")
+outbox.register('activate_payment', activate_payment_job, rate_limiter.PRIORITY_PAYMENT)
+outbox.register('send_access_links', send_access_links_job, rate_limiter.PRIORITY_PAYMENT)
 
 # --- WEBHOOKS E CICLO DE VIDA ---
 # 1. Coloque o ConversationHandler do admin PRIMEIRO.
@@ -309,6 +387,14 @@ bot_app.add_handler(CommandHandler("suporte", support_command))
 # 3. Coloque o CallbackQueryHandler geral por ÚLTIMO.
 bot_app.add_handler(CallbackQueryHandler(button_handler))
 
+# 4. Mudanças no status do bot, no título e nos membros dos grupos (registro, cache de títulos e índice de membros).
+bot_app.add_handler(ChatMemberHandler(bot_chat_member_handler, ChatMemberHandler.MY_CHAT_MEMBER))
+bot_app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_TITLE, chat_title_handler))
+bot_app.add_handler(ChatMemberHandler(group_member_handler, ChatMemberHandler.CHAT_MEMBER))
+
+# Tipos de atualização com handler acima; os demais não são pedidos ao Telegram (set_webhook)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.MY_CHAT_MEMBER, Update.CHAT_MEMBER]
+
 # --- ROTA PARA EXECUTAR O SCHEDULER EXTERNAMENTE ---
 # Pega o token secreto das variáveis de ambiente
 SCHEDULER_SECRET_TOKEN = os.getenv("SCHEDULER_SECRET_TOKEN")
@@ -320,26 +406,56 @@ async def run_scheduler_webhook():
         logger.warning("Tentativa de acesso não autorizado ao webhook do scheduler.")
         abort(403)
 
-    logger.info("Webhook do scheduler acionado. Executando tarefas agendadas...")
+    # Avisos e expulsões do scheduler são tráfego em massa: cedem lugar às entregas de pagamento
+    with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+        started, status = await scheduler.trigger_run(db.supabase, bot_app.bot)
 
-    # -- MODIFICAÇÃO AQUI --
-    # Injetamos as dependências já existentes (bot e cliente supabase)
-    # em vez de chamar scheduler.main()
-    async def run_tasks():
-        logger.info("--- Iniciando verificação do scheduler ---")
-        await scheduler.find_and_process_expiring_subscriptions(db.supabase, bot_app.bot)
-        await scheduler.find_and_process_expired_subscriptions(db.supabase, bot_app.bot)
-        logger.info("--- Verificação do scheduler concluída ---")
+    if started:
+        logger.info("Webhook do scheduler acionado. Executando tarefas agendadas...")
+        return jsonify(status), 200
+    # Já existe uma execução (aqui ou em outra instância): devolve o estado dela
+    logger.info(f"Webhook do scheduler acionado durante uma execução em andamento ({status['state']}). Ignorando.")
+    return jsonify(status), 200
 
-    asyncio.create_task(run_tasks())
 
-    return "Scheduler tasks triggered.", 200
+@app.route("/scheduler/status", methods=['GET'])
+async def scheduler_status():
+    auth_token = request.headers.get("Authorization")
+    if not SCHEDULER_SECRET_TOKEN or auth_token != f"Bearer {SCHEDULER_SECRET_TOKEN}":
+        abort(403)
+    # Estado local (execução em andamento nesta instância) + execuções registradas no DB
+    return jsonify({
+        "instance": scheduler.get_run_status(),
+        "shards": shards.get_stats(),
+        "runs": await scheduler.get_recent_runs(db.supabase),
+    }), 200
 
 
 @app.before_serving
 async def startup():
     await bot_app.initialize()
     await bot_app.start()
+    # Workers que processam as atualizações enfileiradas pelo webhook do Telegram
+    await update_workers.start(bot_app)
+
+    # Conexão keep-alive com o Mercado Pago, compartilhada por cobranças e webhooks
+    await mp_client.start()
+    # Pré-carrega o catálogo de produtos para que /start, /renovar e pay_ não consultem o DB
+    await db.preload_products()
+    # Carrega o registro de grupos e inicia a recarga periódica (grupos e títulos) em segundo plano
+    await group_registry.start(bot_app.bot)
+    # Mantém links de convite de uso único prontos para entrega imediata após o pagamento
+    await invite_pool.start(bot_app.bot)
+    # Índice (grupo, usuário) persistido, evitando get_chat_member por par
+    await membership.load()
+    # Com SCHEDULER_SHARDS > 1, assume a parte desta instância dos shards do scheduler
+    await shards.start()
+    # Timers de aviso/expiração por assinatura; o /webhook/run-scheduler segue como varredura de segurança
+    await expiry_timers.load(bot_app.job_queue, bot_app.bot)
+    # Workers do outbox (ativação, links e avisos); depois dos registros e timers que os jobs usam
+    await outbox.start(bot_app.bot)
+    with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+        await scheduler.start(db.supabase, bot_app.bot)
 
     # --- NOVO CÓDIGO AQUI ---
     # Define a lista de comandos que aparecerão no menu
@@ -354,19 +470,69 @@ async def startup():
     logger.info("Comandos do menu registrados com sucesso.")
     # --- FIM DO NOVO CÓDIGO ---
 
-    await bot_app.bot.set_webhook(url=TELEGRAM_WEBHOOK_URL, secret_token=TELEGRAM_SECRET_TOKEN)
+    # 'chat_member' só é entregue pelo Telegram quando pedido explicitamente
+    await bot_app.bot.set_webhook(
+        url=TELEGRAM_WEBHOOK_URL,
+        secret_token=TELEGRAM_SECRET_TOKEN,
+        allowed_updates=ALLOWED_UPDATES,
+    )
     logger.info("Bot inicializado e webhook registrado com sucesso.")
 
 @app.after_serving
 async def shutdown():
+    await scheduler.stop()
+    await update_workers.stop()
+    await outbox.stop()
     await bot_app.stop()
     await bot_app.shutdown()
+    await expiry_timers.stop()
+    await shards.stop()
+    await invite_pool.stop()
+    await group_registry.stop()
+    await mp_client.close()
+    await db.close()
     logger.info("Bot desligado.")
 
 @app.route("/")
 async def health_check():
     return "Bot is alive and running!", 200
 
+@app.route("/internal/stats", methods=['GET'])
+async def internal_stats():
+    auth_token = request.headers.get("Authorization")
+    if not SCHEDULER_SECRET_TOKEN or auth_token != f"Bearer {SCHEDULER_SECRET_TOKEN}":
+        abort(403)
+    # Métricas de operação: fila do webhook, limitador do Telegram, latências do DB e do Mercado Pago, cache de produtos, índice de membros e timers de expiração
+    return jsonify({
+        "updates": update_workers.get_stats(),
+        "rate_limiter": bot_app.bot.rate_limiter.stats,
+        "db": db.get_query_stats(),
+        "mercadopago": mp_client.get_request_stats(),
+        "mp_notifications": mp_notifications.get_stats(),
+        "outbox": outbox.get_stats(),
+        "product_cache": db.get_product_cache_stats(),
+        "membership": membership.get_stats(),
+        "expiry_timers": expiry_timers.get_stats(),
+    }), 200
+
+@app.route("/internal/products/reload", methods=['POST'])
+async def reload_products():
+    auth_token = request.headers.get("Authorization")
+    if not SCHEDULER_SECRET_TOKEN or auth_token != f"Bearer {SCHEDULER_SECRET_TOKEN}":
+        abort(403)
+    # Produtos são editados direto no Supabase: após alterar preço/duração, chame esta rota em
+    # cada instância. Com {"product_id": N} só esse produto sai do cache (recarregado no próximo uso)
+    data = await request.get_json(silent=True) or {}
+    product_id = data.get('product_id') if isinstance(data, dict) else None
+    if product_id is not None:
+        if not isinstance(product_id, int):
+            return "Error", 400
+        db.invalidate_product_cache(product_id)
+        return jsonify({"invalidated": product_id, "product_cache": db.get_product_cache_stats()}), 200
+    db.invalidate_product_cache()
+    loaded = await db.preload_products()
+    return jsonify({"reloaded": loaded, "product_cache": db.get_product_cache_stats()}), 200
+
 @app.route("/webhook/telegram", methods=['POST'])
 async def telegram_webhook():
     secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
@@ -374,12 +540,19 @@ async def telegram_webhook():
         abort(403)
     try:
         update_data = await request.get_json()
-        update = Update.de_json(update_data, bot_app.bot)
-        await bot_app.process_update(update)
-        return "OK", 200
     except Exception as e:
         logger.error(f"Erro no webhook do Telegram: {e}", exc_info=True)
-        return "Error", 500
+        return "Error", 400
+    if not isinstance(update_data, dict):
+        logger.warning("Webhook do Telegram recebeu um corpo que não é um objeto JSON.")
+        return "Error", 400
+    # Tipos sem handler (ex.: webhook registrado antes do allowed_updates) são confirmados e descartados
+    if not any(update_type in update_data for update_type in ALLOWED_UPDATES):
+        return "OK", 200
+    # Responde assim que a atualização entra na fila (reenvios do mesmo update_id são descartados)
+    if not await update_workers.enqueue(update_data):
+        return "Busy", 503
+    return "OK", 200
 
 @app.route("/webhook/mercadopago", methods=['POST'])
 async def mercadopago_webhook():
@@ -389,21 +562,10 @@ async def mercadopago_webhook():
     if data and data.get("action") == "payment.updated":
         payment_id = data.get("data", {}).get("id")
         if payment_id:
-            # Apenas processamos pagamentos que estão REALMENTE aprovados
-            # Consultamos a API do MP para ter certeza
-            try:
-                async with httpx.AsyncClient() as client:
-                    headers = {"Authorization": f"Bearer {MERCADO_PAGO_ACCESS_TOKEN}"}
-                    response = await client.get(f"https://api.mercadopago.com/v1/payments/{payment_id}", headers=headers)
-                    payment_info = response.json()
-
-                if response.status_code == 200 and payment_info.get("status") == "approved":
-                    logger.info(f"Pagamento {payment_id} confirmado como 'approved'. Agendando processamento.")
-                    asyncio.create_task(process_approved_payment(str(payment_id)))
-                else:
-                    logger.info(f"Notificação para pagamento {payment_id} recebida, mas status não é 'approved' (Status: {payment_info.get('status')}). Ignorando.")
-
-            except Exception as e:
-                logger.error(f"Erro ao verificar status do pagamento {payment_id} na API do MP: {e}")
+            # Apenas processamos pagamentos que estão REALMENTE aprovados: a API do MP é consultada
+            # em segundo plano, uma vez por pagamento, e pagamentos já finalizados nem chegam a ela
+            outcome = mp_notifications.handle(str(payment_id), process_approved_payment)
+            if outcome != "started":
+                logger.info(f"Notificação repetida para o pagamento {payment_id} ({outcome}). Ignorando.")
 
     return "OK", 200
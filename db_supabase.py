@@ -1,10 +1,14 @@
 # --- START OF FILE db_supabase.py (ARQUITETURA DE ASSINATURAS) ---
 
 import os
-import asyncio
+import time
 import logging
 from datetime import datetime, timedelta, timezone
-from supabase import create_client, Client
+from typing import AsyncIterator
+
+import httpx
+from postgrest import AsyncPostgrestClient
+from postgrest.types import ReturnMethod
 from telegram import User as TelegramUser
 
 logger = logging.getLogger(__name__)
@@ -13,148 +17,278 @@ url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_KEY")
 TIMEZONE_BR = timezone(timedelta(hours=-3))
 
-supabase: Client = None
+# --- CONFIGURAÇÃO DO POOL HTTP PARA O POSTGREST ---
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", 20))
+SUPABASE_POOL_KEEPALIVE = int(os.getenv("SUPABASE_POOL_KEEPALIVE", 10))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", 30.0))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", 5.0))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", 10.0))
+SUPABASE_SLOW_QUERY_MS = float(os.getenv("SUPABASE_SLOW_QUERY_MS", 500))
+
+# --- CACHE DO CATÁLOGO DE PRODUTOS ---
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", 3600))
+
+# --- MEMO DE USUÁRIOS VISTOS RECENTEMENTE ---
+USER_MEMO_TTL = float(os.getenv("USER_MEMO_TTL", 300))
+USER_MEMO_MAX_SIZE = int(os.getenv("USER_MEMO_MAX_SIZE", 10000))
+
+# --- PAGINAÇÃO DE ASSINANTES ATIVOS (deve ser <= max-rows do PostgREST) ---
+ACTIVE_USERS_PAGE_SIZE = int(os.getenv("ACTIVE_USERS_PAGE_SIZE", 500))
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """Cliente PostgREST assíncrono com um único pool HTTP/2 keep-alive."""
+
+    def create_session(self, base_url, headers, timeout, verify=True) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            follow_redirects=True,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=SUPABASE_POOL_SIZE,
+                max_keepalive_connections=SUPABASE_POOL_KEEPALIVE,
+                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+
+supabase: PooledPostgrestClient = None
 if not url or not key:
     logger.critical("ERRO CRÍTICO: Credenciais do Supabase (URL ou KEY) não encontradas.")
 else:
     try:
-        supabase: Client = create_client(url, key)
-        logger.info("✅ Cliente Supabase criado com sucesso.")
+        supabase = PooledPostgrestClient(
+            f"{url}/rest/v1",
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "apikey": key,
+                "Authorization": f"Bearer {key}",
+            },
+            timeout=httpx.Timeout(SUPABASE_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT),
+        )
+        logger.info(f"✅ Cliente PostgREST assíncrono criado (pool de {SUPABASE_POOL_SIZE} conexões).")
     except Exception as e:
         logger.critical(f"Falha ao criar o cliente Supabase: {e}", exc_info=True)
 
 
+# --- MÉTRICAS DE LATÊNCIA POR QUERY ---
+_query_stats: dict[str, dict] = {}
+
+async def execute(query_name: str, query):
+    """Executa uma query do PostgREST registrando a latência sob o nome informado."""
+    started = time.perf_counter()
+    try:
+        return await query.execute()
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = _query_stats.setdefault(query_name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if elapsed_ms >= SUPABASE_SLOW_QUERY_MS:
+            logger.warning(f"🐢 [DB] Query lenta '{query_name}': {elapsed_ms:.1f} ms")
+        else:
+            logger.debug(f"[DB] Query '{query_name}': {elapsed_ms:.1f} ms")
+
+def get_query_stats() -> dict[str, dict]:
+    """Retorna contagem, latência média e máxima (ms) de cada query executada."""
+    return {
+        name: {
+            "count": s["count"],
+            "avg_ms": round(s["total_ms"] / s["count"], 2) if s["count"] else 0.0,
+            "max_ms": round(s["max_ms"], 2),
+        }
+        for name, s in _query_stats.items()
+    }
+
+async def close():
+    """Fecha o pool HTTP do PostgREST. Chamado no shutdown da aplicação."""
+    if supabase:
+        await supabase.aclose()
+        logger.info(f"[DB] Pool do PostgREST fechado. Latências: {get_query_stats()}")
+        logger.info(f"[DB] Cache de produtos: {get_product_cache_stats()}")
+
+
+# telegram_user_id -> (instante de expiração, linha do usuário)
+_user_memo: dict[int, tuple[float, dict]] = {}
+
 async def get_or_create_user(tg_user: TelegramUser) -> dict | None:
-    # (Esta função permanece a mesma da versão anterior, sem alterações necessárias)
+    """
+    Garante que o usuário existe (e com nome/username atualizados) em um único upsert.
+    Usuários vistos há menos de USER_MEMO_TTL segundos são servidos da memória,
+    então /start seguido de um clique em pay_ não vai ao DB duas vezes.
+    """
+    memo = _user_memo.get(tg_user.id)
+    if memo and memo[0] > time.monotonic():
+        user_data = memo[1]
+        if user_data.get('first_name') == tg_user.first_name and user_data.get('username') == tg_user.username:
+            return user_data
+
     if not supabase: return None
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('users').select('id, first_name, username').eq('telegram_user_id', tg_user.id).execute()
+        # Depende do índice único em users.telegram_user_id (migrations/001_users_upsert.sql)
+        response = await execute(
+            'get_or_create_user',
+            supabase.table('users').upsert({
+                "telegram_user_id": tg_user.id,
+                "first_name": tg_user.first_name,
+                "username": tg_user.username
+            }, on_conflict='telegram_user_id')
         )
-        if response.data:
-            user_data = response.data[0]
-            if user_data.get('first_name') != tg_user.first_name or user_data.get('username') != tg_user.username:
-                await asyncio.to_thread(
-                    lambda: supabase.table('users').update({
-                        "first_name": tg_user.first_name,
-                        "username": tg_user.username
-                    }).eq('telegram_user_id', tg_user.id).execute()
-                )
-            return user_data
-        else:
-            await asyncio.to_thread(
-                lambda: supabase.table('users').insert({
-                    "telegram_user_id": tg_user.id,
-                    "first_name": tg_user.first_name,
-                    "username": tg_user.username
-                }).execute()
-            )
-            new_user_response = await asyncio.to_thread(
-                lambda: supabase.table('users').select('id, first_name, username').eq('telegram_user_id', tg_user.id).execute()
-            )
-            return new_user_response.data[0] if new_user_response.data else None
+        user_data = response.data[0] if response.data else None
+        if user_data:
+            if len(_user_memo) >= USER_MEMO_MAX_SIZE:
+                _user_memo.clear()
+            _user_memo[tg_user.id] = (time.monotonic() + USER_MEMO_TTL, user_data)
+        return user_data
     except Exception as e:
         logger.error(f"❌ [DB] Erro inesperado em get_or_create_user para {tg_user.id}: {e}", exc_info=True)
         return None
 
 # --- NOVAS FUNÇÕES ---
 
+# product_id -> (instante de expiração, dados do produto)
+_product_cache: dict[int, tuple[float, dict]] = {}
+_product_cache_stats = {"hits": 0, "misses": 0}
+
+def _cache_product(product: dict):
+    _product_cache[product['id']] = (time.monotonic() + PRODUCT_CACHE_TTL, product)
+
 async def get_product_by_id(product_id: int) -> dict | None:
-    """Busca os detalhes de um produto pelo seu ID."""
+    """Busca os detalhes de um produto pelo seu ID (com cache em memória e TTL)."""
+    cached = _product_cache.get(product_id)
+    if cached and cached[0] > time.monotonic():
+        _product_cache_stats["hits"] += 1
+        return cached[1]
+    _product_cache_stats["misses"] += 1
+
     if not supabase: return None
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('products').select('*').eq('id', product_id).single().execute()
+        response = await execute(
+            'get_product_by_id',
+            supabase.table('products').select('*').eq('id', product_id).single()
         )
+        if response.data:
+            _cache_product(response.data)
         return response.data
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar produto {product_id}: {e}", exc_info=True)
         return None
 
-async def create_pending_subscription(db_user_id: int, product_id: int, mp_payment_id: str) -> dict | None:
-    """Cria um registro de assinatura com status 'pending_payment'."""
+async def preload_products() -> int:
+    """Carrega todo o catálogo de produtos no cache em uma única query. Chamado no startup."""
+    if not supabase: return 0
+    try:
+        response = await execute('preload_products', supabase.table('products').select('*'))
+        for product in response.data or []:
+            _cache_product(product)
+        logger.info(f"✅ [DB] {len(response.data or [])} produtos carregados no cache.")
+        return len(response.data or [])
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao pré-carregar produtos: {e}", exc_info=True)
+        return 0
+
+def invalidate_product_cache(product_id: int | None = None):
+    """Remove um produto (ou todo o catálogo, se product_id for None) do cache."""
+    if product_id is None:
+        _product_cache.clear()
+    else:
+        _product_cache.pop(product_id, None)
+    logger.info(f"[DB] Cache de produtos invalidado ({'todos' if product_id is None else product_id}).")
+
+def get_product_cache_stats() -> dict:
+    """Retorna hits, misses e tamanho atual do cache de produtos."""
+    return {**_product_cache_stats, "size": len(_product_cache)}
+
+async def create_pending_subscription(db_user_id: int, product_id: int, mp_payment_id: str, pix_charge: dict | None = None) -> dict | None:
+    """
+    Cria um registro de assinatura com status 'pending_payment'. `pix_charge`
+    (qr_code_base64, pix_copy_paste, expires_at) guarda a cobrança para ser
+    reenviada por get_open_pix_charge (migrations/009_subscription_pix_cache.sql).
+    """
     if not supabase: return None
     try:
         logger.info(f"💾 [DB] Registrando assinatura pendente para user {db_user_id}, produto {product_id}...")
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions').insert({
-                "user_id": db_user_id,
-                "product_id": product_id,
-                "mp_payment_id": mp_payment_id,
-                "status": "pending_payment"
-            }).execute()
+        row = {
+            "user_id": db_user_id,
+            "product_id": product_id,
+            "mp_payment_id": mp_payment_id,
+            "status": "pending_payment"
+        }
+        if pix_charge:
+            row.update(
+                pix_qr_code_base64=pix_charge['qr_code_base64'],
+                pix_copy_paste=pix_charge['pix_copy_paste'],
+                pix_expires_at=pix_charge['expires_at'],
+            )
+        response = await execute(
+            'create_pending_subscription',
+            supabase.table('subscriptions').insert(row)
         )
         return response.data[0] if response.data else None
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao criar assinatura pendente: {e}", exc_info=True)
         return None
 
-async def activate_subscription(mp_payment_id: str) -> dict | None:
-    """Ativa uma assinatura, definindo as datas de início e fim."""
+async def get_open_pix_charge(telegram_user_id: int, product_id: int, valid_until: datetime) -> dict | None:
+    """
+    Busca a cobrança PIX pendente mais recente do usuário para o produto que ainda
+    vale depois de `valid_until`. Retorna qr_code_base64, pix_copy_paste,
+    expires_at e mp_payment_id, ou None se não houver.
+    """
     if not supabase: return None
     try:
-        # 1. Busca a assinatura e o produto associado
-        sub_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('*, product:products(*)')
-            .eq('mp_payment_id', mp_payment_id)
-            .single()
-            .execute()
+        response = await execute(
+            'get_open_pix_charge',
+            supabase.table('subscriptions')
+            .select('mp_payment_id, pix_qr_code_base64, pix_copy_paste, pix_expires_at, user:users!inner(telegram_user_id)')
+            .eq('user.telegram_user_id', telegram_user_id)
+            .eq('product_id', product_id)
+            .eq('status', 'pending_payment')
+            .gt('pix_expires_at', valid_until.isoformat())
+            .not_.is_('pix_copy_paste', 'null')
+            .order('pix_expires_at', desc=True)
+            .limit(1)
         )
-        if not sub_response.data:
-            logger.warning(f"⚠️ [DB] Assinatura com mp_payment_id {mp_payment_id} não encontrada para ativação.")
+        if not response.data:
             return None
-
-        subscription = sub_response.data
-        product = subscription.get('product')
-
-        if subscription.get('status') == 'active':
-            logger.warning(f"⚠️ [DB] Assinatura {subscription['id']} já está ativa. Ignorando.")
-            # --- CORREÇÃO APLICADA AQUI ---
-            # Se já estiver ativa, precisamos buscar os dados do usuário para retornar
-            user_data_response = await asyncio.to_thread(
-                lambda: supabase.table('subscriptions')
-                .select('*, user:users(telegram_user_id)')
-                .eq('mp_payment_id', mp_payment_id)
-                .single()
-                .execute()
-            )
-            return user_data_response.data if user_data_response.data else None
-
-
-        # 2. Calcula as datas
-        start_date = datetime.now(TIMEZONE_BR)
-        end_date = None
-        if product and product.get('duration_days'):
-            end_date = start_date + timedelta(days=product['duration_days'])
-
-        # 3. Atualiza o registro
-        update_payload = {
-            "status": "active",
-            "start_date": start_date.isoformat(),
-            "end_date": end_date.isoformat() if end_date else None
+        row = response.data[0]
+        return {
+            'mp_payment_id': row['mp_payment_id'],
+            'qr_code_base64': row['pix_qr_code_base64'],
+            'pix_copy_paste': row['pix_copy_paste'],
+            'expires_at': row['pix_expires_at'],
         }
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao buscar cobrança PIX em aberto para {telegram_user_id}: {e}")
+        return None
 
-        # --- CORREÇÃO APLICADA AQUI: SEPARAMOS UPDATE DO SELECT ---
-        # 3.1. Primeiro, apenas executamos a atualização.
-        await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .update(update_payload)
-            .eq('mp_payment_id', mp_payment_id)
-            .execute()
-        )
-
-        # 3.2. Agora, buscamos os dados atualizados em uma nova query.
-        final_data_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('*, user:users(telegram_user_id)') # Retorna o tg_user_id
-            .eq('mp_payment_id', mp_payment_id)
-            .single() # Usamos single() pois esperamos apenas um resultado
-            .execute()
+async def activate_subscription(mp_payment_id: str) -> dict | None:
+    """
+    Ativa uma assinatura em uma única chamada RPC (migrations/002_activate_subscription.sql).
+    Retorna a assinatura com 'user': {'telegram_user_id'} e 'activated', que só é True
+    para a chamada que de fato fez a transição de 'pending_payment' para 'active'.
+    """
+    if not supabase: return None
+    try:
+        response = await execute(
+            'activate_subscription',
+            supabase.rpc('activate_subscription', {'p_mp_payment_id': mp_payment_id})
         )
+        subscription = response.data
+        if not subscription:
+            logger.warning(f"⚠️ [DB] Assinatura com mp_payment_id {mp_payment_id} não encontrada para ativação.")
+            return None
 
-        logger.info(f"✅ [DB] Assinatura {subscription['id']} ativada para o pagamento {mp_payment_id}.")
-        return final_data_response.data if final_data_response.data else None
+        if subscription.get('activated'):
+            logger.info(f"✅ [DB] Assinatura {subscription['id']} ativada para o pagamento {mp_payment_id}.")
+        else:
+            logger.warning(f"⚠️ [DB] Assinatura {subscription['id']} não estava pendente (status: {subscription.get('status')}). Ignorando.")
+        return subscription
 
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao ativar assinatura {mp_payment_id}: {e}", exc_info=True)
@@ -164,13 +298,13 @@ async def get_user_active_subscription(telegram_user_id: int) -> dict | None:
     """Busca a assinatura ativa de um usuário, incluindo dados do produto."""
     if not supabase: return None
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('users')
+        response = await execute(
+            'get_user_active_subscription',
+            supabase.table('users')
             .select('*, subscriptions(*, product:products(*))')
             .eq('telegram_user_id', telegram_user_id)
             .eq('subscriptions.status', 'active')
             .single()
-            .execute()
         )
         if response.data and response.data.get('subscriptions'):
             # A API retorna uma lista, mesmo que haja apenas uma assinatura ativa
@@ -182,19 +316,6 @@ async def get_user_active_subscription(telegram_user_id: int) -> dict | None:
              logger.error(f"❌ [DB] Erro ao buscar assinatura ativa para {telegram_user_id}: {e}")
         return None
 
-async def get_all_group_ids() -> list[int]:
-    """Busca os IDs de todos os grupos cadastrados."""
-    if not supabase: return []
-    try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('groups').select('telegram_chat_id').execute()
-        )
-        return [item['telegram_chat_id'] for item in response.data] if response.data else []
-    except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar IDs dos grupos: {e}", exc_info=True)
-        return []
-
-
 # --- NOVAS FUNÇÕES DE ADMIN ---
 
 async def find_user_by_id_or_username(identifier: str) -> dict | None:
@@ -209,7 +330,7 @@ async def find_user_by_id_or_username(identifier: str) -> dict | None:
             username = identifier[1:] if identifier.startswith('@') else identifier
             query = query.eq('username', username)
 
-        response = await asyncio.to_thread(lambda: query.single().execute())
+        response = await execute('find_user_by_id_or_username', query.single())
         return response.data
     except Exception as e:
         if "single result" not in str(e): # Ignora erro comum de não encontrar usuário
@@ -231,8 +352,9 @@ async def create_manual_subscription(db_user_id: int, product_id: int, admin_not
             end_date = start_date + timedelta(days=product['duration_days'])
 
         # Cria a assinatura
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        response = await execute(
+            'create_manual_subscription',
+            supabase.table('subscriptions')
             .insert({
                 "user_id": db_user_id,
                 "product_id": product_id,
@@ -240,7 +362,7 @@ async def create_manual_subscription(db_user_id: int, product_id: int, admin_not
                 "status": "active",
                 "start_date": start_date.isoformat(),
                 "end_date": end_date.isoformat() if end_date else None
-            }).execute()
+            })
         )
         logger.info(f"✅ [DB] Assinatura manual criada para o usuário {db_user_id}.")
         return response.data[0] if response.data else None
@@ -252,15 +374,15 @@ async def revoke_subscription(db_user_id: int, admin_notes: str) -> bool:
     """Revoga a assinatura ativa de um usuário."""
     if not supabase: return False
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        await execute(
+            'revoke_subscription',
+            supabase.table('subscriptions')
             .update({
                 "status": "revoked_by_admin",
                 "end_date": datetime.now(TIMEZONE_BR).isoformat()
             })
             .eq('user_id', db_user_id)
             .eq('status', 'active')
-            .execute()
         )
         logger.info(f"✅ [DB] Assinatura do usuário {db_user_id} revogada pelo admin: {admin_notes}")
         return True
@@ -268,33 +390,287 @@ async def revoke_subscription(db_user_id: int, admin_notes: str) -> bool:
         logger.error(f"❌ [DB] Erro ao revogar assinatura do usuário {db_user_id}: {e}")
         return False
 
-async def get_all_active_tg_user_ids() -> list[int]:
-    """Retorna uma lista de Telegram User IDs de todos os usuários com assinatura ativa."""
+async def iter_active_tg_user_ids(page_size: int = ACTIVE_USERS_PAGE_SIZE) -> AsyncIterator[int]:
+    """
+    Gera os Telegram User IDs de todos os usuários com assinatura ativa, sem duplicatas.
+    As assinaturas são lidas em páginas por keyset (id > último id visto), então o
+    consumidor começa a trabalhar assim que a primeira página chega e o resultado
+    não é truncado pelo max-rows do PostgREST.
+    """
+    if not supabase: return
+    seen: set[int] = set()
+    last_id = None
+    while True:
+        try:
+            query = (
+                supabase.table('subscriptions')
+                .select('id, user:users(telegram_user_id)')
+                .eq('status', 'active')
+            )
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            response = await execute('iter_active_tg_user_ids', query.order('id').limit(page_size))
+        except Exception as e:
+            logger.error(f"❌ [DB] Erro ao buscar página de usuários ativos (após id {last_id}): {e}")
+            return
+
+        page = response.data or []
+        for item in page:
+            user_id = (item.get('user') or {}).get('telegram_user_id')
+            if user_id and user_id not in seen:
+                seen.add(user_id)
+                yield user_id
+
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['id']
+
+async def iter_active_subscriptions_with_end_date(page_size: int = ACTIVE_USERS_PAGE_SIZE, shard_keys: list[int] | None = None,
+                                                  started_since: datetime | None = None) -> AsyncIterator[dict]:
+    """
+    Gera as assinaturas ativas com data de término (id, user_id, end_date e o
+    telegram_user_id do usuário), lidas em páginas por keyset como em
+    iter_active_tg_user_ids. Usado para agendar os timers de expiração no startup.
+    Com `shard_keys`, restringe às assinaturas desses buckets (ver shards.py); com
+    `started_since`, às ativadas/concedidas a partir desse instante (start_date).
+    """
+    if not supabase: return
+    last_id = None
+    while True:
+        try:
+            query = (
+                supabase.table('subscriptions')
+                .select('id, user_id, end_date, user:users(telegram_user_id)')
+                .eq('status', 'active')
+                .not_.is_('end_date', 'null')
+            )
+            if shard_keys is not None:
+                query = query.in_('shard_key', shard_keys)
+            if started_since is not None:
+                query = query.gte('start_date', started_since.isoformat())
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            response = await execute('iter_active_subscriptions_with_end_date', query.order('id').limit(page_size))
+        except Exception as e:
+            logger.error(f"❌ [DB] Erro ao buscar página de assinaturas ativas (após id {last_id}): {e}")
+            return
+
+        page = response.data or []
+        for item in page:
+            yield item
+
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['id']
+
+async def is_subscription_active(subscription_id: int) -> bool | None:
+    """Diz se a assinatura ainda está ativa. Retorna None em caso de erro no DB."""
+    if not supabase: return None
+    try:
+        response = await execute(
+            'is_subscription_active',
+            supabase.table('subscriptions').select('id').eq('id', subscription_id).eq('status', 'active').limit(1)
+        )
+        return bool(response.data)
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao verificar status da assinatura {subscription_id}: {e}")
+        return None
+
+async def get_all_groups_with_names() -> list[dict] | None:
+    """Busca os IDs e nomes de todos os grupos cadastrados. Retorna None em caso de erro."""
+    if not supabase: return None
+    try:
+        response = await execute(
+            'get_all_groups_with_names',
+            supabase.table('groups').select('telegram_chat_id, name')
+        )
+        return response.data if response.data else []
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao buscar grupos com nomes: {e}", exc_info=True)
+        return None
+
+
+# --- ÍNDICE DE MEMBROS DOS GRUPOS (alimentado por atualizações chat_member) ---
+
+async def upsert_group_members(rows: list[dict]) -> bool:
+    """Grava o status de participação de (grupo, usuário). Cada linha: telegram_chat_id, telegram_user_id, status."""
+    if not supabase or not rows: return False
+    try:
+        now_iso = datetime.now(TIMEZONE_BR).isoformat()
+        await execute(
+            'upsert_group_members',
+            supabase.table('group_members').upsert(
+                [{**row, "updated_at": now_iso} for row in rows],
+                on_conflict='telegram_chat_id,telegram_user_id',
+                returning=ReturnMethod.minimal,
+            )
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao gravar membros de grupos: {e}")
+        return False
+
+async def iter_group_members(page_size: int = ACTIVE_USERS_PAGE_SIZE) -> AsyncIterator[dict]:
+    """Gera todas as linhas do índice de membros (telegram_chat_id, telegram_user_id, status), em páginas."""
+    if not supabase: return
+    offset = 0
+    while True:
+        try:
+            response = await execute(
+                'iter_group_members',
+                supabase.table('group_members')
+                .select('telegram_chat_id, telegram_user_id, status')
+                .order('telegram_chat_id')
+                .order('telegram_user_id')
+                .range(offset, offset + page_size - 1)
+            )
+        except Exception as e:
+            logger.error(f"❌ [DB] Erro ao carregar índice de membros (offset {offset}): {e}")
+            return
+        page = response.data or []
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+# --- LEASES ENTRE INSTÂNCIAS (migrations/005_leases.sql) ---
+
+async def acquire_lease(name: str, holder: str, ttl_seconds: int) -> bool:
+    """Adquire ou renova o lease `name` para `holder`. Retorna False se outro holder o detém (ou em erro)."""
+    if not supabase: return False
+    try:
+        response = await execute(
+            'acquire_lease',
+            supabase.rpc('acquire_lease', {'p_name': name, 'p_holder': holder, 'p_ttl_seconds': int(ttl_seconds)})
+        )
+        return bool(response.data)
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao adquirir lease '{name}': {e}")
+        return False
+
+async def release_lease(name: str, holder: str) -> bool:
+    """Libera o lease `name` se ele ainda pertencer a `holder`."""
+    if not supabase: return False
+    try:
+        await execute(
+            'release_lease',
+            supabase.table('leases').delete(returning=ReturnMethod.minimal).eq('name', name).eq('holder', holder)
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao liberar lease '{name}': {e}")
+        return False
+
+async def list_active_leases(prefix: str) -> list[dict]:
+    """Lista os leases não expirados cujo nome começa com `prefix`."""
     if not supabase: return []
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('user:users(telegram_user_id)')
-            .eq('status', 'active')
-            .execute()
+        response = await execute(
+            'list_active_leases',
+            supabase.table('leases')
+            .select('name, holder, expires_at')
+            .like('name', f"{prefix}%")
+            .gt('expires_at', datetime.now(TIMEZONE_BR).isoformat())
         )
-        if not response.data:
-            return []
-        # Extrai os IDs da estrutura aninhada e remove duplicatas
-        user_ids = {item['user']['telegram_user_id'] for item in response.data if item.get('user')}
-        return list(user_ids)
+        return response.data or []
     except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar todos os usuários ativos: {e}")
+        logger.error(f"❌ [DB] Erro ao listar leases '{prefix}*': {e}")
         return []
 
-async def get_all_groups_with_names() -> list[dict]:
-    """Busca os IDs e nomes de todos os grupos cadastrados."""
+async def get_lease(name: str) -> dict | None:
+    """Retorna o dono atual (holder, acquired_at, expires_at) do lease `name`, se houver."""
+    if not supabase: return None
+    try:
+        response = await execute(
+            'get_lease',
+            supabase.table('leases').select('name, holder, acquired_at, expires_at').eq('name', name).limit(1)
+        )
+        return response.data[0] if response.data else None
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao consultar lease '{name}': {e}")
+        return None
+
+
+# --- OUTBOX DE JOBS (migrations/008_outbox_jobs.sql) ---
+
+async def enqueue_outbox_jobs(jobs: list[dict]) -> bool:
+    """
+    Grava jobs no outbox (cada um com kind, payload e, opcionalmente, dedup_key).
+    Jobs com dedup_key já existente são ignorados. Retorna False em caso de erro.
+    """
+    if not supabase or not jobs: return False
+    try:
+        await execute(
+            'enqueue_outbox_jobs',
+            supabase.table('outbox_jobs').upsert(
+                jobs, on_conflict='dedup_key', ignore_duplicates=True, returning=ReturnMethod.minimal,
+            )
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao gravar {len(jobs)} job(s) no outbox: {e}")
+        return False
+
+async def claim_outbox_jobs(worker: str, limit: int, lease_seconds: int, kinds: list[str] | None = None) -> list[dict]:
+    """Reivindica um lote de jobs prontos para `worker` (RPC claim_outbox_jobs), opcionalmente só dos tipos em `kinds`."""
     if not supabase: return []
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('groups').select('telegram_chat_id, name').execute()
+        params = {'p_worker': worker, 'p_limit': limit, 'p_lease_seconds': int(lease_seconds)}
+        if kinds is not None:
+            params['p_kinds'] = kinds
+        response = await execute(
+            'claim_outbox_jobs',
+            supabase.rpc('claim_outbox_jobs', params)
         )
-        return response.data if response.data else []
+        return response.data or []
     except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar grupos com nomes: {e}", exc_info=True)
+        logger.error(f"❌ [DB] Erro ao reivindicar jobs do outbox: {e}")
         return []
+
+async def complete_outbox_jobs(job_ids: list[int]) -> bool:
+    """Marca um lote de jobs como concluído em uma única query."""
+    if not supabase or not job_ids: return False
+    try:
+        await execute(
+            'complete_outbox_jobs',
+            supabase.table('outbox_jobs')
+            .update({'status': 'done', 'locked_until': None, 'updated_at': datetime.now(TIMEZONE_BR).isoformat()}, returning=ReturnMethod.minimal)
+            .in_('id', job_ids)
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao concluir {len(job_ids)} job(s) do outbox: {e}")
+        return False
+
+async def delete_outbox_jobs(kind: str) -> bool:
+    """Apaga todos os jobs de um tipo (usado para limpar os jobs do benchmark)."""
+    if not supabase: return False
+    try:
+        await execute(
+            'delete_outbox_jobs',
+            supabase.table('outbox_jobs').delete(returning=ReturnMethod.minimal).eq('kind', kind)
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao apagar jobs '{kind}' do outbox: {e}")
+        return False
+
+async def fail_outbox_job(job_id: int, error: str, retry_at: datetime | None) -> bool:
+    """Devolve um job para nova tentativa em `retry_at`, ou o marca como 'failed' se retry_at for None."""
+    if not supabase: return False
+    try:
+        update = {'last_error': error[:1000], 'locked_until': None, 'updated_at': datetime.now(TIMEZONE_BR).isoformat()}
+        if retry_at is None:
+            update['status'] = 'failed'
+        else:
+            update.update(status='pending', run_after=retry_at.isoformat())
+        await execute(
+            'fail_outbox_job',
+            supabase.table('outbox_jobs').update(update, returning=ReturnMethod.minimal).eq('id', job_id)
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao registrar falha do job {job_id} do outbox: {e}")
+        return False
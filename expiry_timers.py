@@ -0,0 +1,242 @@
+# --- START OF FILE expiry_timers.py ---
+
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+
+from telegram import Bot
+from telegram.ext import ContextTypes, Job, JobQueue
+
+import db_supabase as db
+import leases
+import rate_limiter
+import scheduler
+import shards
+
+logger = logging.getLogger(__name__)
+
+# Ativações e concessões são tratadas por qualquer instância: a dona dos timers (a do shard,
+# ou a que detém o lease TIMERS_LEASE_NAME sem shards) busca periodicamente as assinaturas
+# iniciadas desde a última busca (com uma sobreposição para atrasos de commit e relógio)
+# e agenda as que ainda não têm timer
+EXPIRY_TIMERS_SYNC_SECONDS = float(os.getenv("EXPIRY_TIMERS_SYNC_SECONDS", 60))
+EXPIRY_TIMERS_SYNC_OVERLAP_SECONDS = float(os.getenv("EXPIRY_TIMERS_SYNC_OVERLAP_SECONDS", 120))
+# Sem shards, só uma instância arma timers; o lease é renovado a cada busca e sobrevive a uma falha
+TIMERS_LEASE_NAME = "expiry_timers"
+TIMERS_LEASE_TTL_SECONDS = int(max(leases.LEASE_TTL_SECONDS, 3 * EXPIRY_TIMERS_SYNC_SECONDS))
+
+_job_queue: JobQueue | None = None
+_sync_task: asyncio.Task | None = None
+# Sem shards: esta instância detém o lease dos timers
+_holds_lease = False
+# nome -> job agendado (JobQueue.get_jobs_by_name percorre todos os jobs a cada chamada)
+_jobs: dict[str, Job] = {}
+# user_id (DB) -> nomes dos jobs agendados para as assinaturas do usuário
+_jobs_by_user: dict[int, set[str]] = {}
+_stats = {"scheduled": 0, "warned": 0, "expired": 0, "skipped": 0, "synced": 0}
+
+
+def _owns(db_user_id: int) -> bool:
+    """Se esta instância arma os timers do usuário: dona do shard ou, sem shards, do lease dos timers."""
+    return shards.owns_user(db_user_id) if shards.is_sharded() else _holds_lease
+
+
+def _remove_job(name: str):
+    job = _jobs.pop(name, None)
+    if job is not None:
+        job.schedule_removal()
+
+
+def _run_once(callback, when, data, name: str):
+    _remove_job(name)
+    _jobs[name] = _job_queue.run_once(callback, when=when, data=data, name=name)
+
+
+def schedule(sub: dict):
+    """
+    Agenda os avisos (um por limiar de scheduler.EXPIRY_WARNING_THRESHOLDS) e a
+    expiração de uma assinatura ativa a partir do seu end_date.
+    A assinatura precisa ter 'id', 'user_id', 'end_date' e 'user': {'telegram_user_id'}.
+    Reagendar a mesma assinatura substitui os timers anteriores.
+    """
+    if _job_queue is None or not sub.get('end_date'):
+        return
+    # Só a instância dona agenda; as demais assinaturas são agendadas pela dona na próxima
+    # busca periódica (_sync_loop)
+    if not _owns(sub['user_id']):
+        return
+    end_date = datetime.fromisoformat(sub['end_date'])
+    now = datetime.now(timezone.utc)
+    expire_name = f"expire:{sub['id']}"
+    for days in scheduler.EXPIRY_WARNING_THRESHOLDS:
+        _remove_job(f"warn{days}:{sub['id']}")
+    names = _jobs_by_user.setdefault(sub['user_id'], set())
+
+    overdue_days = None
+    for days in scheduler.EXPIRY_WARNING_THRESHOLDS:
+        warn_at = end_date - timedelta(days=days)
+        if warn_at > now:
+            _run_once(_warning_job, warn_at, (sub, days), f"warn{days}:{sub['id']}")
+            names.add(f"warn{days}:{sub['id']}")
+        elif overdue_days is None and end_date > now:
+            overdue_days = days
+    if overdue_days is not None:
+        # Limiar já atingido (ex.: processo parado): o ledger garante que o aviso sai uma única vez
+        _run_once(_warning_job, 1, (sub, overdue_days), f"warn{overdue_days}:{sub['id']}")
+        names.add(f"warn{overdue_days}:{sub['id']}")
+    # Assinaturas que venceram com o processo parado expiram logo após o startup
+    _run_once(_expiry_job, max(end_date, now + timedelta(seconds=1)), sub, expire_name)
+    names.add(expire_name)
+    _stats["scheduled"] += 1
+
+
+def cancel_for_user(db_user_id: int):
+    """Cancela os timers de todas as assinaturas do usuário (ex.: acesso revogado por um admin)."""
+    if _job_queue is None:
+        return
+    for name in _jobs_by_user.pop(db_user_id, ()):
+        _remove_job(name)
+
+
+def _forget(sub: dict, name: str):
+    _jobs.pop(name, None)
+    names = _jobs_by_user.get(sub['user_id'])
+    if names is not None:
+        names.discard(name)
+        if not names:
+            del _jobs_by_user[sub['user_id']]
+
+
+async def _warning_job(context: ContextTypes.DEFAULT_TYPE):
+    sub, days = context.job.data
+    _forget(sub, context.job.name)
+    with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+        if await db.is_subscription_active(sub['id']) is False:
+            _stats["skipped"] += 1
+            return
+        try:
+            _stats["warned"] += await scheduler.queue_threshold_warnings(db.supabase, [sub], days)
+        except Exception as e:
+            # O ledger foi liberado: o scheduler externo enfileira o aviso na próxima varredura
+            logger.error(f"[TIMERS] Erro ao enfileirar o aviso da assinatura {sub['id']}: {e}", exc_info=True)
+
+
+async def _expiry_job(context: ContextTypes.DEFAULT_TYPE):
+    sub = context.job.data
+    _forget(sub, context.job.name)
+    with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+        # Renovada, revogada ou já expirada pelo scheduler: nada a fazer
+        if await db.is_subscription_active(sub['id']) is False:
+            _stats["skipped"] += 1
+            return
+        try:
+            await scheduler.expire_subscriptions(db.supabase, context.bot, [sub])
+            _stats["expired"] += 1
+        except Exception as e:
+            # O scheduler externo (/webhook/run-scheduler) recupera o que falhar aqui
+            logger.error(f"[TIMERS] Erro ao expirar a assinatura {sub['id']}: {e}", exc_info=True)
+
+
+def _is_scheduled(sub: dict) -> bool:
+    return f"expire:{sub['id']}" in _jobs_by_user.get(sub['user_id'], ())
+
+
+def _cancel_all():
+    for db_user_id in list(_jobs_by_user):
+        cancel_for_user(db_user_id)
+
+
+async def _renew_lease() -> bool:
+    """Sem shards: adquire/renova o lease dos timers. Retorna True se acabou de assumi-lo."""
+    global _holds_lease
+    held = await leases.acquire(TIMERS_LEASE_NAME, TIMERS_LEASE_TTL_SECONDS)
+    gained = held and not _holds_lease
+    if _holds_lease and not held:
+        # Outra instância assumiu os timers: os daqui disparariam em duplicidade
+        logger.warning("[TIMERS] Lease dos timers perdido. Cancelando os timers desta instância.")
+        _holds_lease = False
+        _cancel_all()
+    _holds_lease = held
+    return gained
+
+
+async def _sync_loop():
+    synced_at = datetime.now(timezone.utc)
+    while True:
+        await asyncio.sleep(EXPIRY_TIMERS_SYNC_SECONDS)
+        try:
+            started_at = datetime.now(timezone.utc)
+            if not shards.is_sharded() and await _renew_lease():
+                count = await _load_shards(None)
+                logger.info(f"[TIMERS] Lease dos timers assumido. Timers agendados para {count} assinatura(s) ativa(s).")
+                synced_at = started_at
+                continue
+            shard_keys = shards.owned_bucket_keys() if shards.is_sharded() else (None if _holds_lease else [])
+            if shard_keys is None or shard_keys:
+                since = synced_at - timedelta(seconds=EXPIRY_TIMERS_SYNC_OVERLAP_SECONDS)
+                async for sub in db.iter_active_subscriptions_with_end_date(shard_keys=shard_keys, started_since=since):
+                    if not _is_scheduled(sub):
+                        schedule(sub)
+                        _stats["synced"] += 1
+            synced_at = started_at
+        except Exception as e:
+            logger.error(f"[TIMERS] Erro ao buscar novas assinaturas desta instância: {e}", exc_info=True)
+
+
+async def _load_shards(shard_keys: list[int] | None) -> int:
+    count = 0
+    async for sub in db.iter_active_subscriptions_with_end_date(shard_keys=shard_keys):
+        schedule(sub)
+        count += 1
+    return count
+
+
+async def _on_shards_changed(gained: set[int], lost: set[int]):
+    # Shards perdidos passam para outra instância, que agenda os timers deles
+    for db_user_id in [uid for uid in _jobs_by_user if shards.shard_of(uid) in lost]:
+        cancel_for_user(db_user_id)
+    if gained:
+        count = await _load_shards(shards.bucket_keys(gained))
+        logger.info(f"[TIMERS] Timers agendados para {count} assinatura(s) dos shards {sorted(gained)}.")
+
+
+async def load(job_queue: JobQueue, bot: Bot) -> int:
+    """
+    Agenda os timers de todas as assinaturas ativas com data de término: só as dos
+    shards desta instância, se houver particionamento, ou todas se esta instância obtiver
+    o lease dos timers (sem shards, as demais instâncias ficam de reserva). Inicia também a
+    busca periódica das assinaturas ativadas em outras instâncias. Chamado no startup, depois de shards.start().
+    """
+    global _job_queue, _sync_task
+    _job_queue = job_queue
+    shards.add_listener(_on_shards_changed)
+    if shards.is_sharded():
+        shard_keys = shards.owned_bucket_keys()
+    else:
+        await _renew_lease()
+        shard_keys = None if _holds_lease else []
+    count = await _load_shards(shard_keys) if shard_keys is None or shard_keys else 0
+    logger.info(f"[TIMERS] Timers de expiração agendados para {count} assinatura(s) ativa(s).")
+    _sync_task = asyncio.create_task(_sync_loop())
+    return count
+
+
+async def stop():
+    """Encerra a busca periódica e libera o lease dos timers, se for desta instância. Chamado no shutdown."""
+    global _sync_task, _holds_lease
+    if _sync_task:
+        _sync_task.cancel()
+        try:
+            await _sync_task
+        except asyncio.CancelledError:
+            pass
+        _sync_task = None
+    if _holds_lease:
+        _holds_lease = False
+        await leases.release(TIMERS_LEASE_NAME)
+
+
+def get_stats() -> dict:
+    """Retorna os contadores dos timers e quantos usuários têm timers pendentes."""
+    return {**_stats, "users": len(_jobs_by_user), "jobs": len(_jobs), "holds_lease": _holds_lease}
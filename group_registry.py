@@ -0,0 +1,152 @@
+# --- START OF FILE group_registry.py ---
+
+import os
+import time
+import asyncio
+import logging
+
+from telegram import Bot
+
+import db_supabase as db
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Intervalo entre recargas da tabela 'groups' em segundo plano
+GROUP_REGISTRY_REFRESH_SECONDS = float(os.getenv("GROUP_REGISTRY_REFRESH_SECONDS", 300))
+# Validade dos títulos de chat em cache (títulos quase nunca mudam)
+CHAT_TITLE_TTL_SECONDS = float(os.getenv("CHAT_TITLE_TTL_SECONDS", 86400))
+
+# telegram_chat_id -> {'telegram_chat_id', 'name'}
+_groups: dict[int, dict] = {}
+_loaded_at: float = 0.0
+_load_lock = asyncio.Lock()
+_refresh_task: asyncio.Task | None = None
+
+# Cache de metadados de chat: telegram_chat_id -> (instante de expiração, título)
+_titles: dict[int, tuple[float, str]] = {}
+
+
+async def refresh() -> int:
+    """Recarrega os grupos do DB em uma única query. Se a consulta falhar, o registro não é marcado como carregado."""
+    global _loaded_at
+    rows = await db.get_all_groups_with_names()
+    if rows is None:
+        # Sem marcar _loaded_at: a próxima leitura tenta de novo em vez de confiar no registro atual por um ciclo inteiro
+        logger.warning(f"[GROUPS] Falha ao recarregar os grupos. Mantendo o registro anterior ({len(_groups)} grupo(s)).")
+        return len(_groups)
+    if not rows and _groups:
+        logger.warning("[GROUPS] Recarga retornou vazio. Mantendo o registro anterior.")
+        return len(_groups)
+
+    new_groups = {}
+    for row in rows:
+        chat_id = row['telegram_chat_id']
+        new_groups[chat_id] = {
+            'telegram_chat_id': chat_id,
+            'name': row.get('name'),
+        }
+    _groups.clear()
+    _groups.update(new_groups)
+    _loaded_at = time.monotonic()
+    logger.info(f"[GROUPS] Registro de grupos carregado: {len(_groups)} grupo(s).")
+    return len(_groups)
+
+
+async def _ensure_loaded():
+    if _loaded_at and time.monotonic() - _loaded_at < GROUP_REGISTRY_REFRESH_SECONDS:
+        return
+    async with _load_lock:
+        # Outra corrotina pode ter carregado enquanto esperávamos o lock
+        if _loaded_at and time.monotonic() - _loaded_at < GROUP_REGISTRY_REFRESH_SECONDS:
+            return
+        await refresh()
+
+
+async def get_group_ids() -> list[int]:
+    """Retorna os IDs de todos os grupos cadastrados."""
+    await _ensure_loaded()
+    return list(_groups)
+
+
+async def get_groups() -> list[dict]:
+    """Retorna ID, nome e título (se conhecido) de todos os grupos cadastrados."""
+    await _ensure_loaded()
+    return [{**group, 'title': get_title(chat_id)} for chat_id, group in _groups.items()]
+
+
+def get_title(chat_id: int) -> str | None:
+    """
+    Título do chat a partir do cache, sem chamar a API do Telegram. Se o título
+    ainda não for conhecido, usa o nome cadastrado em groups.name. Títulos
+    expirados continuam sendo servidos até a recarga em segundo plano.
+    """
+    cached = _titles.get(chat_id)
+    if cached:
+        return cached[1]
+    return (_groups.get(chat_id) or {}).get('name')
+
+
+def set_title(chat_id: int, title: str | None):
+    """Registra o título atual de um chat (obtido via get_chat ou eventos do Telegram)."""
+    if title:
+        _titles[chat_id] = (time.monotonic() + CHAT_TITLE_TTL_SECONDS, title)
+
+
+async def _refresh_stale_titles(bot: Bot):
+    """Atualiza via get_chat apenas os títulos de grupos ausentes ou expirados no cache."""
+    now = time.monotonic()
+    for chat_id in list(_groups):
+        cached = _titles.get(chat_id)
+        if cached and cached[0] > now:
+            continue
+        try:
+            chat = await bot.get_chat(chat_id)
+            set_title(chat_id, chat.title)
+        except Exception as e:
+            logger.warning(f"[GROUPS] Não foi possível obter o título do grupo {chat_id}: {e}")
+
+
+def invalidate():
+    """Força a recarga do registro na próxima consulta (ex.: um grupo foi adicionado)."""
+    global _loaded_at
+    _loaded_at = 0.0
+    logger.info("[GROUPS] Registro de grupos invalidado.")
+
+
+async def _refresh_loop(bot: Bot | None):
+    while True:
+        try:
+            if bot:
+                await _refresh_stale_titles(bot)
+        except Exception as e:
+            logger.error(f"[GROUPS] Erro ao atualizar títulos dos grupos: {e}", exc_info=True)
+        await asyncio.sleep(GROUP_REGISTRY_REFRESH_SECONDS)
+        try:
+            await refresh()
+        except Exception as e:
+            logger.error(f"[GROUPS] Erro ao recarregar o registro de grupos: {e}", exc_info=True)
+
+
+async def start(bot: Bot | None = None):
+    """
+    Carrega o registro e inicia a recarga periódica em segundo plano. Chamado no startup.
+    Com um `bot`, a recarga também busca os títulos ausentes ou expirados no cache.
+    """
+    global _refresh_task
+    await refresh()
+    if _refresh_task is None or _refresh_task.done():
+        with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+            _refresh_task = asyncio.create_task(_refresh_loop(bot))
+
+
+async def stop():
+    """Cancela a recarga em segundo plano. Chamado no shutdown."""
+    global _refresh_task
+    if _refresh_task:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+        _refresh_task = None
@@ -0,0 +1,140 @@
+# --- START OF FILE invite_pool.py ---
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone, timedelta
+
+from telegram import Bot
+
+import group_registry
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURAÇÃO DO POOL DE CONVITES ---
+# Quantos links de uso único ficam prontos por grupo
+INVITE_POOL_DEPTH = int(os.getenv("INVITE_POOL_DEPTH", 3))
+# Intervalo entre rodadas de reposição e máximo de links criados por rodada (todos os grupos)
+INVITE_POOL_REFILL_INTERVAL = float(os.getenv("INVITE_POOL_REFILL_INTERVAL", 30))
+INVITE_POOL_REFILL_BATCH = int(os.getenv("INVITE_POOL_REFILL_BATCH", 10))
+# Links no pool mais velhos que isso são revogados e substituídos
+INVITE_POOL_MAX_AGE = float(os.getenv("INVITE_POOL_MAX_AGE", 6 * 3600))
+# Links entregues são revogados depois desse tempo (mesmo prazo dos links criados na hora)
+INVITE_LINK_HANDOUT_TTL = float(os.getenv("INVITE_LINK_HANDOUT_TTL", 2 * 3600))
+
+# chat_id -> deque de (link, criado_em)
+_pool: dict[int, deque] = {}
+# (chat_id, link) -> entregue_em; revogados ao serem usados ou ao envelhecer
+_handed_out: dict[tuple[int, str], float] = {}
+_stats = {"hits": 0, "misses": 0, "minted": 0, "revoked": 0}
+_refill_task: asyncio.Task | None = None
+
+
+def take(chat_id: int) -> str | None:
+    """Entrega um link de convite pré-criado para o grupo, ou None se o pool estiver vazio."""
+    links = _pool.get(chat_id)
+    if not links:
+        _stats["misses"] += 1
+        return None
+    invite_link, _created_at = links.popleft()
+    _handed_out[(chat_id, invite_link)] = time.monotonic()
+    _stats["hits"] += 1
+    return invite_link
+
+
+async def mark_consumed(bot: Bot, chat_id: int, invite_link: str):
+    """Revoga um link entregue assim que ele é usado para entrar no grupo."""
+    if _handed_out.pop((chat_id, invite_link), None) is not None:
+        await _revoke(bot, chat_id, invite_link)
+
+
+def get_stats() -> dict:
+    """Retorna hits, misses, links criados/revogados e o tamanho atual do pool por grupo."""
+    return {**_stats, "pooled": {chat_id: len(links) for chat_id, links in _pool.items()}, "handed_out": len(_handed_out)}
+
+
+async def _revoke(bot: Bot, chat_id: int, invite_link: str):
+    try:
+        await bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=invite_link)
+        _stats["revoked"] += 1
+    except Exception as e:
+        # Link já expirado/esgotado ou grupo inacessível: nada a fazer
+        logger.debug(f"[INVITES] Não foi possível revogar link do grupo {chat_id}: {e}")
+
+
+async def _mint(bot: Bot, chat_id: int):
+    # O expire_date garante que o link morre sozinho mesmo se o processo reiniciar
+    expire_date = datetime.now(timezone.utc) + timedelta(seconds=INVITE_POOL_MAX_AGE + INVITE_LINK_HANDOUT_TTL)
+    link = await bot.create_chat_invite_link(chat_id=chat_id, expire_date=expire_date, member_limit=1)
+    _pool.setdefault(chat_id, deque()).append((link.invite_link, time.monotonic()))
+    _stats["minted"] += 1
+
+
+async def _maintain(bot: Bot):
+    """Revoga links velhos (no pool e já entregues) e repõe o pool, respeitando o limite por rodada."""
+    now = time.monotonic()
+    group_ids = await group_registry.get_group_ids()
+
+    for (chat_id, invite_link), handed_at in list(_handed_out.items()):
+        if now - handed_at > INVITE_LINK_HANDOUT_TTL:
+            del _handed_out[(chat_id, invite_link)]
+            await _revoke(bot, chat_id, invite_link)
+
+    for chat_id in list(_pool):
+        links = _pool[chat_id]
+        if chat_id not in group_ids:
+            # Grupo removido do cadastro: descarta o pool inteiro
+            del _pool[chat_id]
+            for invite_link, _created_at in links:
+                await _revoke(bot, chat_id, invite_link)
+            continue
+        while links and now - links[0][1] > INVITE_POOL_MAX_AGE:
+            invite_link, _created_at = links.popleft()
+            await _revoke(bot, chat_id, invite_link)
+
+    budget = INVITE_POOL_REFILL_BATCH
+    # Reabastece primeiro os grupos com menos links prontos
+    for chat_id in sorted(group_ids, key=lambda c: len(_pool.get(c, ()))):
+        while budget > 0 and len(_pool.get(chat_id, ())) < INVITE_POOL_DEPTH:
+            budget -= 1
+            try:
+                await _mint(bot, chat_id)
+            except Exception as e:
+                logger.warning(f"[INVITES] Falha ao criar link para o pool do grupo {chat_id}: {e}")
+                break
+
+
+async def _refill_loop(bot: Bot):
+    while True:
+        try:
+            await _maintain(bot)
+        except Exception as e:
+            logger.error(f"[INVITES] Erro na manutenção do pool de convites: {e}", exc_info=True)
+        await asyncio.sleep(INVITE_POOL_REFILL_INTERVAL)
+
+
+async def start(bot: Bot):
+    """Inicia a reposição do pool em segundo plano. Chamado no startup."""
+    global _refill_task
+    if INVITE_POOL_DEPTH <= 0:
+        logger.info("[INVITES] Pool de convites desativado (INVITE_POOL_DEPTH=0).")
+        return
+    if _refill_task is None or _refill_task.done():
+        with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+            _refill_task = asyncio.create_task(_refill_loop(bot))
+
+
+async def stop():
+    """Cancela a reposição em segundo plano. Chamado no shutdown."""
+    global _refill_task
+    if _refill_task:
+        _refill_task.cancel()
+        try:
+            await _refill_task
+        except asyncio.CancelledError:
+            pass
+        _refill_task = None
+    logger.info(f"[INVITES] Pool de convites encerrado: {get_stats()}")
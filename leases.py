@@ -0,0 +1,62 @@
+# --- START OF FILE leases.py ---
+
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import db_supabase as db
+
+logger = logging.getLogger(__name__)
+
+# Identifica esta instância como dona dos leases
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+# Validade de um lease sem renovação; a renovação ocorre a cada terço desse tempo
+LEASE_TTL_SECONDS = int(os.getenv("LEASE_TTL_SECONDS", 120))
+
+
+async def acquire(name: str, ttl_seconds: int = LEASE_TTL_SECONDS) -> bool:
+    """Adquire (ou renova) o lease `name` para esta instância."""
+    return await db.acquire_lease(name, INSTANCE_ID, ttl_seconds)
+
+
+async def release(name: str):
+    """Libera o lease `name`, se ainda for desta instância."""
+    await db.release_lease(name, INSTANCE_ID)
+
+
+async def _heartbeat(name: str, ttl_seconds: int, lost: asyncio.Event):
+    while True:
+        await asyncio.sleep(ttl_seconds / 3)
+        try:
+            renewed = await acquire(name, ttl_seconds)
+        except Exception as e:
+            logger.error(f"[LEASES] Erro ao renovar o lease '{name}': {e}")
+            renewed = False
+        if not renewed:
+            logger.warning(f"[LEASES] Não foi possível renovar o lease '{name}' (expirou ou foi tomado por outra instância). Sinalizando para parar.")
+            lost.set()
+            return
+
+
+@asynccontextmanager
+async def keep_alive(name: str, ttl_seconds: int = LEASE_TTL_SECONDS):
+    """
+    Mantém um lease já adquirido renovado enquanto o bloco executa e o libera ao
+    final. Se o processo morrer, o lease expira sozinho após `ttl_seconds`.
+    Produz um asyncio.Event sinalizado quando uma renovação falha: o bloco deve
+    parar o quanto antes, pois outra instância pode assumir o lease após o TTL.
+    """
+    lost = asyncio.Event()
+    heartbeat = asyncio.create_task(_heartbeat(name, ttl_seconds, lost))
+    try:
+        yield lost
+    finally:
+        heartbeat.cancel()
+        try:
+            await heartbeat
+        except asyncio.CancelledError:
+            pass
+        await release(name)
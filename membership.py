@@ -0,0 +1,91 @@
+# --- START OF FILE membership.py ---
+
+import logging
+
+from telegram import Bot, ChatMemberUpdated
+
+import db_supabase as db
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# (telegram_chat_id, telegram_user_id) -> status no Telegram
+_index: dict[tuple[int, int], str] = {}
+_stats = {"hits": 0, "misses": 0, "events": 0}
+
+
+def _is_member_status(status: str) -> bool:
+    return status in MEMBER_STATUSES
+
+
+async def load():
+    """Carrega o índice persistido no DB para a memória. Chamado no startup."""
+    _index.clear()
+    async for row in db.iter_group_members():
+        _index[(row['telegram_chat_id'], row['telegram_user_id'])] = row['status']
+    logger.info(f"[MEMBERS] Índice de membros carregado: {len(_index)} registro(s).")
+
+
+async def record(chat_id: int, user_id: int, status: str, persist: bool = True):
+    """Registra o status de um usuário em um grupo na memória e, opcionalmente, no DB."""
+    if _index.get((chat_id, user_id)) == status:
+        return
+    _index[(chat_id, user_id)] = status
+    if persist:
+        await db.upsert_group_members([{"telegram_chat_id": chat_id, "telegram_user_id": user_id, "status": status}])
+
+
+async def record_many(entries: list[tuple[int, int, str]]):
+    """Registra vários (chat_id, user_id, status) na memória e grava os que mudaram no DB em uma única query."""
+    changed = []
+    for chat_id, user_id, status in entries:
+        if _index.get((chat_id, user_id)) == status:
+            continue
+        _index[(chat_id, user_id)] = status
+        changed.append({"telegram_chat_id": chat_id, "telegram_user_id": user_id, "status": status})
+    if changed:
+        await db.upsert_group_members(changed)
+
+
+async def is_member(bot: Bot, chat_id: int, user_id: int, use_index: bool = True) -> bool:
+    """
+    Diz se o usuário participa do grupo. Consulta o índice local e só recorre a
+    get_chat_member quando o par (grupo, usuário) ainda não é conhecido ou quando
+    use_index=False (ex.: pedidos de suporte, em que o índice pode estar defasado).
+    Erros do Telegram diferentes de 'user not found' são propagados.
+    """
+    status = _index.get((chat_id, user_id)) if use_index else None
+    if status is not None:
+        _stats["hits"] += 1
+        return _is_member_status(status)
+
+    _stats["misses"] += 1
+    try:
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+        status = member.status
+    except Exception as e:
+        if "user not found" not in str(e).lower():
+            raise
+        status = 'left'
+    await record(chat_id, user_id, status)
+    return _is_member_status(status)
+
+
+async def handle_chat_member_update(change: ChatMemberUpdated) -> str | None:
+    """
+    Atualiza o índice a partir de uma atualização chat_member do Telegram.
+    Retorna o link de convite usado para entrar, se houver.
+    """
+    _stats["events"] += 1
+    chat_id = change.chat.id
+    user_id = change.new_chat_member.user.id
+    await record(chat_id, user_id, change.new_chat_member.status)
+    if change.invite_link and _is_member_status(change.new_chat_member.status):
+        return change.invite_link.invite_link
+    return None
+
+
+def get_stats() -> dict:
+    """Retorna hits/misses das consultas, eventos recebidos e o tamanho do índice."""
+    return {**_stats, "size": len(_index)}
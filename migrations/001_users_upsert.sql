@@ -0,0 +1,3 @@
+-- Necessário para o upsert de get_or_create_user (ON CONFLICT (telegram_user_id)).
+create unique index if not exists users_telegram_user_id_key
+    on public.users (telegram_user_id);
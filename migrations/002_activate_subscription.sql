@@ -0,0 +1,44 @@
+-- Ativação atômica e idempotente de uma assinatura paga (usada por db.activate_subscription).
+-- Apenas uma chamada concorrente consegue a transição 'pending_payment' -> 'active';
+-- notificações duplicadas do Mercado Pago recebem o estado atual com activated = false.
+create or replace function public.activate_subscription(p_mp_payment_id text)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_result jsonb;
+begin
+    update public.subscriptions s
+       set status = 'active',
+           start_date = now(),
+           end_date = case
+               when p.duration_days is null then null
+               else now() + make_interval(days => p.duration_days)
+           end
+      from public.products p, public.users u
+     where s.mp_payment_id = p_mp_payment_id
+       and s.status = 'pending_payment'
+       and p.id = s.product_id
+       and u.id = s.user_id
+    returning to_jsonb(s) || jsonb_build_object(
+               'user', jsonb_build_object('telegram_user_id', u.telegram_user_id),
+               'activated', true
+           )
+      into v_result;
+
+    if v_result is not null then
+        return v_result;
+    end if;
+
+    select to_jsonb(s) || jsonb_build_object(
+               'user', jsonb_build_object('telegram_user_id', u.telegram_user_id),
+               'activated', false
+           )
+      into v_result
+      from public.subscriptions s
+      join public.users u on u.id = s.user_id
+     where s.mp_payment_id = p_mp_payment_id;
+
+    return v_result;
+end;
+$$;
@@ -0,0 +1,8 @@
+-- Índice de participação (grupo, usuário), alimentado pelas atualizações chat_member do Telegram.
+create table if not exists public.group_members (
+    telegram_chat_id bigint not null,
+    telegram_user_id bigint not null,
+    status text not null,
+    updated_at timestamptz not null default now(),
+    primary key (telegram_chat_id, telegram_user_id)
+);
@@ -0,0 +1,9 @@
+-- Ledger de avisos enviados: no máximo um aviso de cada tipo por assinatura
+-- (ex.: expiry_warning_7d, expiry_warning_3d, expiry_warning_1d).
+create table if not exists public.notifications (
+    id bigserial primary key,
+    subscription_id bigint not null references public.subscriptions (id) on delete cascade,
+    notice_type text not null,
+    sent_at timestamptz not null default now(),
+    unique (subscription_id, notice_type)
+);
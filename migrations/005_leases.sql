@@ -0,0 +1,26 @@
+-- Leases com TTL para coordenar trabalho entre instâncias (ex.: execução do scheduler).
+create table if not exists public.leases (
+    name text primary key,
+    holder text not null,
+    acquired_at timestamptz not null default now(),
+    expires_at timestamptz not null
+);
+
+-- Adquire ou renova um lease. Retorna true se `p_holder` passou a ser (ou continua) o dono:
+-- o lease é livre, expirou ou já pertence ao mesmo holder.
+create or replace function public.acquire_lease(p_name text, p_holder text, p_ttl_seconds integer)
+returns boolean
+language plpgsql
+as $$
+begin
+    insert into public.leases as l (name, holder, acquired_at, expires_at)
+    values (p_name, p_holder, now(), now() + make_interval(secs => p_ttl_seconds))
+    on conflict (name) do update
+       set holder = excluded.holder,
+           acquired_at = case when l.holder = excluded.holder then l.acquired_at else now() end,
+           expires_at = excluded.expires_at
+     where l.holder = excluded.holder
+        or l.expires_at < now();
+    return found;
+end;
+$$;
@@ -0,0 +1,8 @@
+-- Particiona o trabalho do scheduler entre instâncias (shards.py): cada assinatura
+-- cai em um de 1024 buckets pelo user_id; o shard i de N fica com os buckets b onde b % N = i.
+alter table public.subscriptions
+    add column if not exists shard_key smallint
+    generated always as ((mod(user_id, 1024))::smallint) stored;
+
+create index if not exists subscriptions_shard_status_end_date_idx
+    on public.subscriptions (shard_key, status, end_date);
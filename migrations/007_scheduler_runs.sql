@@ -0,0 +1,19 @@
+-- Execuções do scheduler com checkpoint: uma execução aberta ('running') por escopo
+-- ('global' ou 'shard:<i>'), retomada do cursor após um restart.
+create table if not exists public.scheduler_runs (
+    id bigserial primary key,
+    scope text not null,
+    holder text not null,
+    state text not null default 'running',
+    cutoff timestamptz not null,
+    cursor jsonb not null default '{}'::jsonb,
+    processed integer not null default 0,
+    total integer,
+    stats jsonb not null default '{}'::jsonb,
+    started_at timestamptz not null default now(),
+    updated_at timestamptz not null default now(),
+    finished_at timestamptz
+);
+
+create unique index if not exists scheduler_runs_open_scope_key
+    on public.scheduler_runs (scope) where state = 'running';
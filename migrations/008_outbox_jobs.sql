@@ -0,0 +1,48 @@
+-- Outbox durável para o trabalho pós-pagamento e os avisos (outbox.py).
+-- dedup_key impede que o mesmo trabalho seja enfileirado duas vezes.
+-- priority segue rate_limiter (0 = pagamento, 2 = em massa): menor é reivindicado antes.
+create table if not exists public.outbox_jobs (
+    id bigserial primary key,
+    kind text not null,
+    payload jsonb not null default '{}'::jsonb,
+    dedup_key text unique,
+    status text not null default 'pending',
+    priority smallint not null default 1,
+    attempts integer not null default 0,
+    run_after timestamptz not null default now(),
+    locked_by text,
+    locked_until timestamptz,
+    last_error text,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists outbox_jobs_status_priority_run_after_idx
+    on public.outbox_jobs (status, priority, run_after);
+
+-- Reivindica até p_limit jobs prontos (ou cujo worker morreu com o job em execução),
+-- opcionalmente só dos tipos em p_kinds (null = todos). Jobs de pagamento passam à frente
+-- de avisos em massa mesmo que estes estejam prontos há mais tempo.
+-- SKIP LOCKED permite que vários workers/instâncias reivindiquem lotes em paralelo sem colisão.
+create or replace function public.claim_outbox_jobs(p_worker text, p_limit integer, p_lease_seconds integer, p_kinds text[] default null)
+returns setof public.outbox_jobs
+language sql
+as $$
+    update public.outbox_jobs j
+       set status = 'running',
+           locked_by = p_worker,
+           locked_until = now() + make_interval(secs => p_lease_seconds),
+           attempts = j.attempts + 1,
+           updated_at = now()
+     where j.id in (
+           select id
+             from public.outbox_jobs
+            where ((status = 'pending' and run_after <= now())
+                or (status = 'running' and locked_until < now()))
+              and (p_kinds is null or kind = any(p_kinds))
+            order by priority, run_after, id
+            limit p_limit
+              for update skip locked
+     )
+    returning j.*;
+$$;
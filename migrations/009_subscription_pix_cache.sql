@@ -0,0 +1,10 @@
+-- Guarda a cobrança PIX junto da assinatura pendente para que novos cliques em pay_
+-- reenviem o mesmo QR Code enquanto ele não expira, sem criar outro pagamento.
+alter table public.subscriptions
+    add column if not exists pix_qr_code_base64 text,
+    add column if not exists pix_copy_paste text,
+    add column if not exists pix_expires_at timestamptz;
+
+create index if not exists subscriptions_pending_pix_idx
+    on public.subscriptions (user_id, product_id, pix_expires_at)
+    where status = 'pending_payment';
@@ -0,0 +1,129 @@
+# --- START OF FILE mp_client.py ---
+
+import os
+import time
+import asyncio
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+MP_API_BASE_URL = "https://api.mercadopago.com"
+
+# --- CONFIGURAÇÃO DO POOL HTTP PARA O MERCADO PAGO ---
+MP_POOL_SIZE = int(os.getenv("MP_POOL_SIZE", 20))
+MP_POOL_KEEPALIVE = int(os.getenv("MP_POOL_KEEPALIVE", 10))
+MP_KEEPALIVE_EXPIRY = float(os.getenv("MP_KEEPALIVE_EXPIRY", 60.0))
+MP_CONNECT_TIMEOUT = float(os.getenv("MP_CONNECT_TIMEOUT", 5.0))
+MP_TIMEOUT = float(os.getenv("MP_TIMEOUT", 10.0))
+# Retentativas (com backoff exponencial) apenas para GETs, que são idempotentes
+MP_GET_RETRIES = int(os.getenv("MP_GET_RETRIES", 3))
+MP_RETRY_BACKOFF = float(os.getenv("MP_RETRY_BACKOFF", 0.5))
+MP_SLOW_REQUEST_MS = float(os.getenv("MP_SLOW_REQUEST_MS", 1500))
+
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_client: httpx.AsyncClient | None = None
+_request_stats: dict[str, dict] = {}
+
+
+def _create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=MP_API_BASE_URL,
+        # Lido aqui (e não na importação) para respeitar o load_dotenv() do app
+        headers={"Authorization": f"Bearer {os.getenv('MERCADO_PAGO_ACCESS_TOKEN')}"},
+        timeout=httpx.Timeout(MP_TIMEOUT, connect=MP_CONNECT_TIMEOUT),
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=MP_POOL_SIZE,
+            max_keepalive_connections=MP_POOL_KEEPALIVE,
+            keepalive_expiry=MP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+    return _client
+
+
+async def start():
+    """Cria o cliente e abre a conexão com a API (TCP + TLS) antes do primeiro pagamento. Chamado no startup."""
+    client = _get_client()
+    try:
+        # Qualquer resposta serve: o objetivo é deixar uma conexão pronta no pool
+        await client.get("/v1/payment_methods")
+    except httpx.HTTPError as e:
+        logger.warning(f"[MP] Não foi possível aquecer a conexão com o Mercado Pago: {e}")
+    logger.info(f"[MP] Cliente do Mercado Pago criado (pool de {MP_POOL_SIZE} conexões).")
+
+
+async def close():
+    """Fecha o pool HTTP do Mercado Pago. Chamado no shutdown da aplicação."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info(f"[MP] Pool do Mercado Pago fechado. Latências: {get_request_stats()}")
+
+
+def _record(name: str, started: float):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = _request_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "retries": 0})
+    stats["count"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    if elapsed_ms >= MP_SLOW_REQUEST_MS:
+        logger.warning(f"🐢 [MP] Requisição lenta '{name}': {elapsed_ms:.1f} ms")
+
+
+def get_request_stats() -> dict[str, dict]:
+    """Retorna contagem, latência média e máxima (ms) e retentativas de cada operação."""
+    return {
+        name: {
+            "count": s["count"],
+            "avg_ms": round(s["total_ms"] / s["count"], 2) if s["count"] else 0.0,
+            "max_ms": round(s["max_ms"], 2),
+            "retries": s["retries"],
+        }
+        for name, s in _request_stats.items()
+    }
+
+
+async def _get(name: str, path: str) -> dict:
+    """GET com retentativas para erros de rede, 429 e 5xx. Levanta httpx.HTTPError se todas falharem."""
+    for attempt in range(MP_GET_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            response = await _get_client().get(path)
+            if response.status_code not in _RETRYABLE_STATUS or attempt >= MP_GET_RETRIES:
+                response.raise_for_status()
+                return response.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.HTTPStatusError) or attempt >= MP_GET_RETRIES:
+                raise
+        finally:
+            _record(name, started)
+        _request_stats[name]["retries"] += 1
+        await asyncio.sleep(MP_RETRY_BACKOFF * 2 ** attempt)
+
+
+async def create_payment(payload: dict, idempotency_key: str) -> dict:
+    """Cria um pagamento (POST /v1/payments). Sem retentativa automática. Levanta httpx.HTTPError em falhas."""
+    started = time.perf_counter()
+    try:
+        response = await _get_client().post(
+            "/v1/payments", json=payload, headers={"X-Idempotency-Key": idempotency_key}
+        )
+        response.raise_for_status()
+        return response.json()
+    finally:
+        _record("create_payment", started)
+
+
+async def get_payment(payment_id: str) -> dict:
+    """Consulta um pagamento (GET /v1/payments/{id}), com retentativas. Levanta httpx.HTTPError em falhas."""
+    return await _get("get_payment", f"/v1/payments/{payment_id}")
@@ -0,0 +1,94 @@
+# --- START OF FILE mp_notifications.py ---
+
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import mp_client
+
+logger = logging.getLogger(__name__)
+
+# Status em que um pagamento do Mercado Pago não muda mais
+MP_FINAL_STATUSES = ('approved', 'rejected', 'cancelled', 'refunded', 'charged_back')
+# Quantos pagamentos já finalizados são lembrados para ignorar notificações repetidas
+MP_FINAL_CACHE_SIZE = int(os.getenv("MP_FINAL_CACHE_SIZE", 10000))
+
+# mp_payment_id -> task de verificação em andamento (uma por pagamento)
+_inflight: dict[str, asyncio.Task] = {}
+# Pagamentos que receberam notificação durante uma consulta já em andamento: a consulta
+# pode ter visto o status anterior, então é refeita se o resultado não for final
+_recheck: set[str] = set()
+# LRU mp_payment_id -> status final já processado
+_final: OrderedDict[str, str] = OrderedDict()
+_stats = {"received": 0, "checked": 0, "rechecked": 0, "coalesced": 0, "short_circuited": 0, "approved": 0}
+
+
+def _remember_final(payment_id: str, status: str):
+    _final[payment_id] = status
+    _final.move_to_end(payment_id)
+    if len(_final) > MP_FINAL_CACHE_SIZE:
+        _final.popitem(last=False)
+
+
+async def _check_once(payment_id: str, on_approved: Callable[[str], Awaitable[bool]]):
+    _stats["checked"] += 1
+    try:
+        payment_info = await mp_client.get_payment(payment_id)
+    except Exception as e:
+        logger.error(f"Erro ao verificar status do pagamento {payment_id} na API do MP: {e}")
+        return
+
+    status = payment_info.get("status")
+    if status == "approved":
+        logger.info(f"Pagamento {payment_id} confirmado como 'approved'. Processando.")
+        _stats["approved"] += 1
+        # Só vira final depois de processado: se a ativação falhar, a próxima notificação tenta de novo
+        if await on_approved(payment_id):
+            _remember_final(payment_id, status)
+    else:
+        logger.info(f"Notificação para pagamento {payment_id} recebida, mas status não é 'approved' (Status: {status}). Ignorando.")
+        if status in MP_FINAL_STATUSES:
+            _remember_final(payment_id, status)
+
+
+async def _check(payment_id: str, on_approved: Callable[[str], Awaitable[bool]]):
+    while True:
+        # Notificações que chegarem a partir daqui não são cobertas por esta consulta
+        _recheck.discard(payment_id)
+        await _check_once(payment_id, on_approved)
+        if payment_id in _final or payment_id not in _recheck:
+            return
+        _stats["rechecked"] += 1
+        logger.info(f"Pagamento {payment_id} recebeu notificação durante a consulta. Consultando de novo.")
+
+
+def handle(payment_id: str, on_approved: Callable[[str], Awaitable[bool]]) -> str:
+    """
+    Trata uma notificação de pagamento sem bloquear o webhook. Pagamentos já
+    finalizados são ignorados sem nenhuma chamada externa; notificações que chegam
+    enquanto o mesmo pagamento está sendo verificado são agrupadas na verificação
+    em andamento, que consulta de novo ao terminar se o status visto não for final.
+    `on_approved(payment_id)` deve retornar True quando o pagamento estiver
+    resolvido. Retorna o que foi feito: 'final', 'coalesced' ou 'started'.
+    """
+    _stats["received"] += 1
+    if payment_id in _final:
+        _final.move_to_end(payment_id)
+        _stats["short_circuited"] += 1
+        return "final"
+    if payment_id in _inflight:
+        _recheck.add(payment_id)
+        _stats["coalesced"] += 1
+        return "coalesced"
+
+    task = asyncio.create_task(_check(payment_id, on_approved))
+    _inflight[payment_id] = task
+    task.add_done_callback(lambda _task: (_inflight.pop(payment_id, None), _recheck.discard(payment_id)))
+    return "started"
+
+
+def get_stats() -> dict:
+    """Retorna os contadores de notificações e quantos pagamentos estão em verificação ou em cache."""
+    return {**_stats, "inflight": len(_inflight), "final_cached": len(_final)}
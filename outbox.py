@@ -0,0 +1,216 @@
+# --- START OF FILE outbox.py ---
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+from telegram import Bot
+
+# Antes dos módulos locais, que leem as variáveis de ambiente na importação (execução via python -m outbox)
+load_dotenv()
+
+import db_supabase as db
+import leases
+import rate_limiter
+from utils import run_bounded
+
+logger = logging.getLogger(__name__)
+
+# Jobs executados em paralelo por instância e tamanho do lote reivindicado por vez
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 8))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 20))
+# Espera máxima entre consultas quando o outbox está vazio (jobs locais acordam o worker na hora)
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 2.0))
+# Tempo que um job reivindicado fica reservado; depois disso outro worker pode retomá-lo
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", 300))
+# Retentativas com backoff exponencial (OUTBOX_RETRY_BASE * 2^tentativas, até OUTBOX_RETRY_MAX)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 5))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 3600))
+
+# kind -> (handler(bot, payload), prioridade no rate limiter)
+_handlers: dict[str, tuple[Callable[[Bot, dict], Awaitable[None]], int]] = {}
+_wakeup = asyncio.Event()
+_dispatch_task: asyncio.Task | None = None
+_stats = {"enqueued": 0, "claimed": 0, "done": 0, "retried": 0, "failed": 0, "batches": 0, "busy_seconds": 0.0}
+
+
+def register(kind: str, handler: Callable[[Bot, dict], Awaitable[None]], priority: int = rate_limiter.PRIORITY_DEFAULT):
+    """
+    Registra o handler de um tipo de job. O handler recebe (bot, payload) e deve
+    levantar exceção para que o job seja tentado de novo.
+    """
+    _handlers[kind] = (handler, priority)
+
+
+def _priority_of(kind: str) -> int:
+    entry = _handlers.get(kind)
+    return entry[1] if entry else rate_limiter.PRIORITY_DEFAULT
+
+
+async def enqueue_many(jobs: list[tuple[str, dict, str | None]]) -> bool:
+    """
+    Grava jobs (kind, payload, dedup_key) no outbox em uma única query. Jobs cujo
+    dedup_key já existe são ignorados. Cada job leva a prioridade registrada para o seu
+    tipo, e os workers reivindicam primeiro os de menor prioridade (pagamentos antes de
+    avisos em massa). Retorna False se não foi possível gravar.
+    """
+    rows = [
+        {'kind': kind, 'payload': payload, 'dedup_key': dedup_key, 'priority': _priority_of(kind)}
+        for kind, payload, dedup_key in jobs
+    ]
+    if not await db.enqueue_outbox_jobs(rows):
+        return False
+    _stats["enqueued"] += len(rows)
+    # Acorda o worker local para que jobs de pagamento não esperem o próximo ciclo
+    _wakeup.set()
+    return True
+
+
+async def enqueue(kind: str, payload: dict, dedup_key: str | None = None) -> bool:
+    """Grava um job no outbox. Veja enqueue_many."""
+    return await enqueue_many([(kind, payload, dedup_key)])
+
+
+def _retry_at(attempts: int) -> datetime | None:
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        return None
+    delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+    return datetime.now(timezone.utc) + timedelta(seconds=delay)
+
+
+async def _run_job(bot: Bot, job: dict) -> bool:
+    entry = _handlers.get(job['kind'])
+    try:
+        if entry is None:
+            raise LookupError(f"Nenhum handler registrado para jobs '{job['kind']}'")
+        handler, priority = entry
+        with rate_limiter.priority(priority):
+            await handler(bot, job['payload'])
+        return True
+    except Exception as e:
+        retry_at = _retry_at(job['attempts'])
+        if retry_at is None:
+            _stats["failed"] += 1
+            logger.error(f"[OUTBOX] Job {job['id']} ({job['kind']}) falhou definitivamente após {job['attempts']} tentativa(s): {e}", exc_info=True)
+        else:
+            _stats["retried"] += 1
+            logger.warning(f"[OUTBOX] Job {job['id']} ({job['kind']}) falhou (tentativa {job['attempts']}): {e}. Nova tentativa às {retry_at.isoformat()}.")
+        await db.fail_outbox_job(job['id'], str(e), retry_at)
+        return False
+
+
+async def process_batch(bot: Bot, kinds: list[str] | None = None) -> int:
+    """
+    Reivindica um lote (só dos tipos em `kinds`, se informado), executa os jobs em
+    paralelo e marca os concluídos em uma query. Retorna o tamanho do lote.
+    """
+    jobs = await db.claim_outbox_jobs(leases.INSTANCE_ID, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, kinds)
+    if not jobs:
+        return 0
+    started = time.perf_counter()
+    _stats["claimed"] += len(jobs)
+    _stats["batches"] += 1
+    results = await run_bounded(jobs, lambda job: _run_job(bot, job), OUTBOX_CONCURRENCY)
+    done_ids = [job['id'] for job, ok in zip(jobs, results) if ok]
+    await db.complete_outbox_jobs(done_ids)
+    _stats["done"] += len(done_ids)
+    _stats["busy_seconds"] += time.perf_counter() - started
+    return len(jobs)
+
+
+async def _dispatch_loop(bot: Bot):
+    while True:
+        # Limpa antes de reivindicar: um enqueue() durante o lote deixa o sinal ligado e
+        # o worker volta a consultar sem esperar o próximo ciclo
+        _wakeup.clear()
+        try:
+            # Só os tipos com handler: jobs de outro processo (ex.: o benchmark) não são tocados.
+            # Lote cheio: provavelmente há mais jobs prontos, então segue sem esperar
+            if await process_batch(bot, kinds=sorted(_handlers)) >= OUTBOX_BATCH_SIZE:
+                continue
+        except Exception as e:
+            logger.error(f"[OUTBOX] Erro ao processar lote do outbox: {e}", exc_info=True)
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start(bot: Bot):
+    """Inicia o worker do outbox em segundo plano. Chamado no startup."""
+    global _dispatch_task
+    if _dispatch_task is None or _dispatch_task.done():
+        _dispatch_task = asyncio.create_task(_dispatch_loop(bot))
+        logger.info(f"[OUTBOX] Worker do outbox iniciado (lotes de {OUTBOX_BATCH_SIZE}, {OUTBOX_CONCURRENCY} em paralelo).")
+
+
+async def stop():
+    """Cancela o worker. Jobs reivindicados e não concluídos voltam ao outbox quando o lease expira."""
+    global _dispatch_task
+    if _dispatch_task:
+        _dispatch_task.cancel()
+        try:
+            await _dispatch_task
+        except asyncio.CancelledError:
+            pass
+        _dispatch_task = None
+    logger.info(f"[OUTBOX] Worker do outbox encerrado: {get_stats()}")
+
+
+def get_stats() -> dict:
+    """Retorna os contadores do outbox e a vazão (jobs concluídos por segundo de processamento)."""
+    busy = _stats["busy_seconds"]
+    return {**_stats, "busy_seconds": round(busy, 3), "jobs_per_second": round(_stats["done"] / busy, 2) if busy > 0 else 0.0}
+
+
+# --- BENCHMARK: python -m outbox --benchmark N ---
+
+BENCHMARK_KIND = "benchmark_noop"
+
+
+async def _benchmark(count: int) -> dict:
+    """
+    Enfileira `count` jobs vazios e mede quanto tempo os workers levam para concluí-los.
+    Só reivindica jobs do benchmark (os jobs reais pendentes não são tocados) e os apaga ao final.
+    Levanta RuntimeError se não for possível enfileirar os jobs.
+    """
+    register(BENCHMARK_KIND, lambda bot, payload: asyncio.sleep(0))
+    run_tag = f"{leases.INSTANCE_ID}-{int(time.time())}"
+    try:
+        for offset in range(0, count, 500):
+            if not await enqueue_many([(BENCHMARK_KIND, {"n": n}, f"benchmark:{run_tag}:{n}") for n in range(offset, min(offset + 500, count))]):
+                raise RuntimeError("Não foi possível enfileirar os jobs do benchmark no outbox.")
+        started = time.perf_counter()
+        while _stats["done"] + _stats["failed"] < count:
+            if not await process_batch(None, kinds=[BENCHMARK_KIND]):
+                break
+        elapsed = time.perf_counter() - started
+    finally:
+        await db.delete_outbox_jobs(BENCHMARK_KIND)
+    return {**get_stats(), "wall_seconds": round(elapsed, 3), "wall_jobs_per_second": round(_stats["done"] / elapsed, 2) if elapsed > 0 else 0.0}
+
+
+async def _main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m outbox", description="Mede a vazão do outbox com jobs vazios.")
+    parser.add_argument("--benchmark", type=int, required=True, metavar="N", help="quantidade de jobs a enfileirar e processar")
+    args = parser.parse_args(argv)
+    try:
+        print(await _benchmark(args.benchmark))
+        return 0
+    except RuntimeError as e:
+        logger.error(f"[OUTBOX] Benchmark abortado: {e}")
+        return 1
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', stream=sys.stdout)
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
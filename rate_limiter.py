@@ -0,0 +1,161 @@
+# --- START OF FILE rate_limiter.py ---
+
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextvars
+from contextlib import contextmanager
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# --- LIMITES DA BOT API ---
+# Global: ~30 mensagens/s por bot. Por chat: ~1 msg/s em privado e 20 msg/min em grupos.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", 30))
+TELEGRAM_PRIVATE_CHAT_RATE = float(os.getenv("TELEGRAM_PRIVATE_CHAT_RATE", 1))
+TELEGRAM_GROUP_CHAT_RATE = float(os.getenv("TELEGRAM_GROUP_CHAT_RATE", 20 / 60))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+
+# --- PRIORIDADES (menor = mais urgente) ---
+PRIORITY_PAYMENT = 0   # entrega de acesso após pagamento
+PRIORITY_DEFAULT = 1   # respostas a comandos e botões
+PRIORITY_BULK = 2      # broadcasts, convites em massa e scheduler
+
+_current_priority: contextvars.ContextVar[int] = contextvars.ContextVar("telegram_priority", default=PRIORITY_DEFAULT)
+
+
+@contextmanager
+def priority(level: int):
+    """Define a prioridade das chamadas à Bot API feitas dentro do bloco (e das tasks criadas nele)."""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def _is_message_endpoint(endpoint: str) -> bool:
+    # Endpoints que contam para o limite por chat (envio e edição de mensagens)
+    return endpoint.startswith(("send", "copyMessage", "forwardMessage", "editMessage"))
+
+
+class _ChatBucket:
+    """Token bucket por reserva: cada chamada reserva um token e recebe quanto deve esperar."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+class TelegramRateLimiter(BaseRateLimiter[int]):
+    """
+    Limitador único para todas as chamadas do bot. Aplica o limite global (token
+    bucket com fila por prioridade), o limite por chat nos envios de mensagem e
+    respeita RetryAfter pausando todo o tráfego antes de repetir a chamada.
+    O `rate_limit_args` das chamadas (ou o bloco `priority(...)`) define a prioridade.
+    """
+
+    def __init__(self):
+        self._tokens = TELEGRAM_GLOBAL_BURST
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._condition = asyncio.Condition()
+        self._chat_buckets: dict[int | str, _ChatBucket] = {}
+        self.stats = {"requests": 0, "retry_after": 0, "waited_seconds": 0.0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        logger.info(f"[RATE] Limitador encerrado: {self.stats}")
+
+    def _refill(self, now: float):
+        self._tokens = min(TELEGRAM_GLOBAL_BURST, self._tokens + (now - self._updated) * TELEGRAM_GLOBAL_RATE)
+        self._updated = now
+
+    async def _acquire_global(self, level: int):
+        ticket = (level, next(self._sequence))
+        async with self._condition:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiters[0] == ticket:
+                        now = time.monotonic()
+                        self._refill(now)
+                        if now >= self._paused_until and self._tokens >= 1:
+                            heapq.heappop(self._waiters)
+                            self._tokens -= 1
+                            self._condition.notify_all()
+                            return
+                        timeout = max(self._paused_until - now, (1 - self._tokens) / TELEGRAM_GLOBAL_RATE)
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                # Cancelado enquanto esperava: sai da fila sem consumir token
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self._condition.notify_all()
+                raise
+
+    async def _acquire_chat(self, chat_id: int | str):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.idle()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chat_buckets[chat_id] = _ChatBucket(
+                TELEGRAM_GROUP_CHAT_RATE if is_group else TELEGRAM_PRIVATE_CHAT_RATE, TELEGRAM_CHAT_BURST
+            )
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        level = rate_limit_args if rate_limit_args is not None else _current_priority.get()
+        chat_id = data.get("chat_id")
+        started = time.monotonic()
+
+        if chat_id is not None and _is_message_endpoint(endpoint):
+            await self._acquire_chat(chat_id)
+
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            await self._acquire_global(level)
+            self.stats["waited_seconds"] += time.monotonic() - started
+            self.stats["requests"] += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt >= TELEGRAM_MAX_RETRIES:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                logger.warning(f"[RATE] Flood control em {endpoint}: pausando todas as chamadas por {retry_after}s.")
+                async with self._condition:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    self._condition.notify_all()
+                started = time.monotonic()
@@ -1,19 +1,36 @@
 # --- START OF FILE scheduler.py (VERSÃO CORRIGIDA E COMPLETA) ---
 
 import os
+import json
 import asyncio
+import argparse
+import contextlib
 import logging
 import sys
+import time
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient
+from postgrest.types import CountMethod
 from telegram import Bot
-from telegram.error import BadRequest, Forbidden
+from telegram.ext import ExtBot
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+# Antes dos módulos locais, que leem as variáveis de ambiente na importação (execução via python -m scheduler)
+load_dotenv()
+
+import db_supabase as db
+import group_registry
+import leases
+import membership
+import outbox
+import rate_limiter
+import shards
+from utils import run_bounded
 
 # --- CONFIGURAÇÃO ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', stream=sys.stdout)
 logger = logging.getLogger("Scheduler")
-load_dotenv()
 
 # Carrega as mesmas variáveis de ambiente
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -21,111 +38,732 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TIMEZONE_BR = timezone(timedelta(hours=-3))
 
+# Processamento de expirações em lotes
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 200))
+# Pares (usuário, grupo) processados em paralelo e duração do ban temporário usado na remoção.
+# O Telegram trata bans com menos de 30s restantes (ou já vencidos) como permanentes; como a
+# chamada pode esperar no rate limiter, a margem é de minutos e o ban é desfeito se ficar curta
+KICK_CONCURRENCY = int(os.getenv("KICK_CONCURRENCY", 10))
+KICK_BAN_SECONDS = max(int(os.getenv("KICK_BAN_SECONDS", 300)), 120)
+_PERMANENT_BAN_THRESHOLD = timedelta(seconds=30)
+# Limiares dos avisos de vencimento, em dias antes do end_date (um aviso por limiar)
+EXPIRY_WARNING_THRESHOLDS = sorted({int(days) for days in os.getenv("EXPIRY_WARNING_THRESHOLDS", "7,3,1").split(",") if days.strip()})
+
+# Prazo (time.monotonic) da execução corrente, definido por --time-budget na CLI.
+# Ao esgotar, os passes param entre lotes e a execução fica aberta para ser retomada.
+_deadline: float | None = None
+# Sinalizado por leases.keep_alive quando a renovação do lease falha: outra instância pode
+# assumir a execução após o TTL, então os passes param no próximo lote
+_lease_lost: asyncio.Event | None = None
+# Shard do escopo em execução (modo com shards): se um rebalanceamento o passar para outra
+# instância, os passes param entre lotes e a nova dona retoma a execução pelo checkpoint
+_scope_shard: int | None = None
+_STOP_REASONS = ("lease_lost", "shard_lost", "budget_exhausted")
+
+
+def _stop_reason() -> str | None:
+    """Motivo para interromper a execução entre lotes (lease ou shard perdido, tempo esgotado), ou None."""
+    if _lease_lost is not None and _lease_lost.is_set():
+        return "lease_lost"
+    if _scope_shard is not None and not shards.owns_shard(_scope_shard):
+        return "shard_lost"
+    if _deadline is not None and time.monotonic() >= _deadline:
+        return "budget_exhausted"
+    return None
+
+
 # --- FUNÇÃO REUTILIZÁVEL ---
-async def kick_user_from_all_groups(user_id: int, bot: Bot):
-    """Expulsa e desbane um usuário de todos os grupos listados no DB."""
-    # Conexão com Supabase dentro da função para ser autônoma
-    supabase_client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+async def _kick_from_group(bot: Bot, user_id: int, group_id: int) -> str:
+    """
+    Remove um usuário de um grupo com um ban temporário. Retorna o resultado do par.
+    O índice de membros não é consultado: uma atualização chat_member perdida deixaria um usuário vencido no grupo.
+    Erros do Telegram viram 'failed' para não derrubar o lote inteiro.
+    """
+    try:
+        # until_date calculado por chamada: o usuário sai agora e o ban expira sozinho
+        until_date = datetime.now(timezone.utc) + timedelta(seconds=KICK_BAN_SECONDS)
+        await bot.ban_chat_member(chat_id=group_id, user_id=user_id, until_date=until_date)
+        if until_date - datetime.now(timezone.utc) < _PERMANENT_BAN_THRESHOLD:
+            # A chamada esperou tanto (rate limiter, RetryAfter) que o ban pode ter virado permanente
+            await bot.unban_chat_member(chat_id=group_id, user_id=user_id, only_if_banned=True)
+        logger.info(f"[kick_user] Usuário {user_id} removido do grupo {group_id}.")
+        return "removed"
+    except Forbidden:
+        logger.warning(f"[kick_user] Sem permissão para remover {user_id} do grupo {group_id}.")
+        return "failed"
+    except BadRequest as e:
+        if "user not found" in str(e).lower() or "member not found" in str(e).lower():
+            logger.info(f"[kick_user] Usuário {user_id} já não estava no grupo {group_id}.")
+            return "not_member"
+        logger.error(f"[kick_user] Erro do Telegram ao remover {user_id} do {group_id}: {e}")
+        return "failed"
+    except TelegramError as e:
+        # TimedOut, NetworkError, RetryAfter esgotado...: o par é refeito na próxima execução
+        logger.error(f"[kick_user] Falha ao remover {user_id} do {group_id}: {e}")
+        return "failed"
 
-    groups_response = await asyncio.to_thread(
-        lambda: supabase_client.table('groups').select('telegram_chat_id').execute()
-    )
-    group_ids = [g['telegram_chat_id'] for g in groups_response.data]
+
+async def kick_users_from_all_groups(user_ids: list[int], bot: Bot) -> dict:
+    """
+    Remove um lote de usuários de todos os grupos listados no DB, processando os pares
+    (usuário, grupo) em paralelo (até KICK_CONCURRENCY por vez) com uma chamada por par.
+    O índice de membros é atualizado ao final, com uma única gravação para o lote.
+    Retorna os totais do lote e, em 'per_user', de quantos grupos cada usuário foi removido.
+    """
+    result = {"removed": 0, "not_member": 0, "failed": 0, "per_user": {user_id: 0 for user_id in user_ids}}
+    # Os grupos vêm do registro em memória, compartilhado com utils e admin_handlers
+    group_ids = await group_registry.get_group_ids()
 
     if not group_ids:
-        logger.error(f"CRÍTICO: [kick_user] Nenhum grupo encontrado no DB. Não é possível remover {user_id}.")
-        return 0
+        logger.error(f"CRÍTICO: [kick_user] Nenhum grupo encontrado no DB. Não é possível remover {len(user_ids)} usuário(s).")
+        return result
 
-    removed_count = 0
-    for group_id in group_ids:
-        try:
-            await bot.ban_chat_member(chat_id=group_id, user_id=user_id)
-            await bot.unban_chat_member(chat_id=group_id, user_id=user_id, only_if_banned=True)
-            logger.info(f"[kick_user] Usuário {user_id} removido do grupo {group_id}.")
-            removed_count += 1
-        except Forbidden:
-            logger.warning(f"[kick_user] Sem permissão para remover {user_id} do grupo {group_id}.")
-        except BadRequest as e:
-            if "user not found" in str(e) or "member not found" in str(e):
-                logger.info(f"[kick_user] Usuário {user_id} já não estava no grupo {group_id}.")
-            else:
-                logger.error(f"[kick_user] Erro do Telegram ao remover {user_id} do {group_id}: {e}")
-    return removed_count
+    pairs = [(user_id, group_id) for user_id in user_ids for group_id in group_ids]
+    outcomes = await run_bounded(
+        pairs,
+        lambda pair: _kick_from_group(bot, pair[0], pair[1]),
+        KICK_CONCURRENCY,
+    )
+    statuses = []
+    for (user_id, group_id), outcome in zip(pairs, outcomes):
+        result[outcome] += 1
+        if outcome == "removed":
+            result["per_user"][user_id] += 1
+            statuses.append((group_id, user_id, 'kicked'))
+        elif outcome == "not_member":
+            statuses.append((group_id, user_id, 'left'))
+    await membership.record_many(statuses)
+    return result
 
 # --- FUNÇÕES DO SCHEDULER (A FUNÇÃO QUE FALTAVA FOI REINSERIDA) ---
 
-async def find_and_process_expiring_subscriptions(supabase: Client, bot: Bot):
-    """Encontra assinaturas que estão para vencer e envia avisos."""
+async def send_expiry_warning(bot: Bot, sub: dict) -> bool:
+    """Envia o aviso de vencimento próximo de uma assinatura ao usuário."""
+    user_id = (sub.get('user') or {}).get('telegram_user_id')
+    if not user_id:
+        return False
+    end_date_br = datetime.fromisoformat(sub['end_date']).astimezone(TIMEZONE_BR).strftime('%d/%m/%Y')
+    message = f"Olá! 👋 Sua assinatura está próxima de vencer (em {end_date_br}). Para não perder o acesso, use o comando /renovar e efetue o pagamento."
     try:
-        three_days_from_now = (datetime.now(TIMEZONE_BR) + timedelta(days=3)).isoformat()
-        two_days_from_now = (datetime.now(TIMEZONE_BR) + timedelta(days=2)).isoformat()
+        await bot.send_message(chat_id=user_id, text=message)
+        logger.info(f"Aviso de vencimento enviado para o usuário {user_id}.")
+        return True
+    except (Forbidden, BadRequest):
+        logger.warning(f"Não foi possível enviar aviso para o usuário {user_id} (bloqueou o bot?).")
+        return False
 
-        # Busca assinaturas que vencem em exatamente 3 dias (entre 2 e 3 dias a partir de agora)
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('*, user:users(telegram_user_id)')
-            .eq('status', 'active')
-            .lte('end_date', three_days_from_now)
-            .gte('end_date', two_days_from_now)
-            .execute()
+
+def warning_notice_type(days: int) -> str:
+    """Tipo do aviso no ledger 'notifications' para o limiar de `days` dias."""
+    return f"expiry_warning_{days}d"
+
+
+async def _claim_notices(supabase: AsyncPostgrestClient, notices: list[tuple[int, str]]) -> set[tuple[int, str]]:
+    """
+    Registra avisos (subscription_id, notice_type) no ledger 'notifications' com
+    ON CONFLICT DO NOTHING e retorna apenas os que ainda não estavam registrados.
+    """
+    if not notices:
+        return set()
+    response = await db.execute(
+        'scheduler_claim_notices',
+        supabase.table('notifications')
+        .upsert(
+            [{'subscription_id': subscription_id, 'notice_type': notice_type} for subscription_id, notice_type in notices],
+            on_conflict='subscription_id,notice_type',
+            ignore_duplicates=True,
         )
+    )
+    return {(row['subscription_id'], row['notice_type']) for row in response.data or []}
+
+
+async def _release_notices(supabase: AsyncPostgrestClient, notices: set[tuple[int, str]]):
+    """Desfaz registros de _claim_notices cujo aviso não chegou a ser enfileirado."""
+    for notice_type in {notice_type for _sub_id, notice_type in notices}:
+        sub_ids = [sub_id for sub_id, t in notices if t == notice_type]
+        await db.execute(
+            'scheduler_release_notices',
+            supabase.table('notifications').delete().eq('notice_type', notice_type).in_('subscription_id', sub_ids)
+        )
+
+
+async def queue_threshold_warnings(supabase: AsyncPostgrestClient, batch: list[dict], days: int) -> int:
+    """
+    Enfileira no outbox o aviso do limiar de `days` dias de um lote de assinaturas,
+    uma única vez por assinatura. O aviso é registrado no ledger antes, junto com os
+    limiares maiores já superados, para que execuções repetidas ou concorrentes não
+    enfileirem o mesmo aviso duas vezes nem vários avisos de uma vez.
+    Retorna quantos avisos foram enfileirados.
+    """
+    notices = [(sub['id'], warning_notice_type(d)) for sub in batch for d in EXPIRY_WARNING_THRESHOLDS if d >= days]
+    claimed = await _claim_notices(supabase, notices)
+    jobs = [
+        ('expiry_warning', {'subscription_id': sub['id'], 'telegram_user_id': sub['user']['telegram_user_id'], 'end_date': sub['end_date']},
+         f"expiry_warning:{sub['id']}:{days}")
+        for sub in batch
+        if (sub['id'], warning_notice_type(days)) in claimed and (sub.get('user') or {}).get('telegram_user_id')
+    ]
+    if jobs and not await outbox.enqueue_many(jobs):
+        # Sem o job, o registro no ledger impediria o aviso para sempre
+        await _release_notices(supabase, claimed)
+        raise RuntimeError(f"Não foi possível enfileirar {len(jobs)} aviso(s) de {days} dia(s) no outbox.")
+    return len(jobs)
+
+
+async def _expiry_warning_job(bot: Bot, payload: dict):
+    """Job do outbox: envia um aviso de vencimento próximo."""
+    await send_expiry_warning(bot, {'end_date': payload['end_date'], 'user': {'telegram_user_id': payload['telegram_user_id']}})
+
 
-        if not response.data:
+async def find_and_process_expiring_subscriptions(supabase: AsyncPostgrestClient, bot: Bot, shard_keys: list[int] | None = None,
+                                                  run: dict | None = None) -> dict:
+    """
+    Enfileira os avisos de vencimento de cada limiar de EXPIRY_WARNING_THRESHOLDS. A busca
+    faz anti-join com o ledger 'notifications', então cada assinatura recebe no máximo
+    um aviso por limiar, independente da frequência do cron. Os limiares são
+    processados do menor para o maior: quem já está perto do fim recebe só o aviso
+    mais urgente. Com `shard_keys`, processa só os buckets desses shards. Com `run`
+    (ver _open_run), grava um checkpoint por lote e retoma do cursor salvo.
+    Retorna quantos avisos foram enfileirados por limiar.
+    """
+    stats: dict = {}
+    cursor = run['cursor'] if run else {}
+    if cursor.get('phase') == 'expired':
+        # Execução retomada já tinha concluído os avisos
+        return stats
+    try:
+        now = datetime.now(TIMEZONE_BR)
+        for days in EXPIRY_WARNING_THRESHOLDS:
+            if cursor.get('phase') == 'warnings' and days < cursor['threshold']:
+                continue
+            notice_type = warning_notice_type(days)
+            stats[notice_type] = 0
+            last_id = cursor.get('last_id') if cursor.get('threshold') == days else None
+            while True:
+                if reason := _stop_reason():
+                    stats[reason] = True
+                    return stats
+                query = (
+                    supabase.table('subscriptions')
+                    .select('id, user_id, end_date, user:users(telegram_user_id), notifications!left(id)')
+                    .eq('status', 'active')
+                    .gt('end_date', now.isoformat())
+                    .lte('end_date', (now + timedelta(days=days)).isoformat())
+                    .eq('notifications.notice_type', notice_type)
+                    .is_('notifications', 'null')
+                )
+                if shard_keys is not None:
+                    query = query.in_('shard_key', shard_keys)
+                if last_id is not None:
+                    query = query.gt('id', last_id)
+                response = await db.execute('scheduler_expiring_batch', query.order('id').limit(EXPIRY_BATCH_SIZE))
+
+                batch = response.data or []
+                if not batch:
+                    break
+                last_id = batch[-1]['id']
+
+                # Uma query no ledger e uma no outbox por lote; o envio fica com os workers do outbox
+                stats[notice_type] += await queue_threshold_warnings(supabase, batch, days)
+                if run:
+                    await _checkpoint(supabase, run, {'phase': 'warnings', 'threshold': days, 'last_id': last_id}, stats=stats)
+
+                if len(batch) < EXPIRY_BATCH_SIZE:
+                    break
+
+        if not any(stats.values()):
             logger.info("Nenhuma assinatura encontrada para enviar aviso de vencimento.")
-            return
-
-        for sub in response.data:
-            user_id = sub.get('user', {}).get('telegram_user_id')
-            if user_id:
-                end_date_br = datetime.fromisoformat(sub['end_date']).astimezone(TIMEZONE_BR).strftime('%d/%m/%Y')
-                message = f"Olá! 👋 Sua assinatura está próxima de vencer (em {end_date_br}). Para não perder o acesso, use o comando /renovar e efetue o pagamento."
-                try:
-                    await bot.send_message(chat_id=user_id, text=message)
-                    logger.info(f"Aviso de vencimento enviado para o usuário {user_id}.")
-                except (Forbidden, BadRequest):
-                    logger.warning(f"Não foi possível enviar aviso para o usuário {user_id} (bloqueou o bot?).")
+        else:
+            logger.info(f"Avisos de vencimento enfileirados: {stats}")
     except Exception as e:
         logger.error(f"Erro ao processar avisos de expiração: {e}", exc_info=True)
+        stats["error"] = str(e)
+    return stats
 
 
-async def find_and_process_expired_subscriptions(supabase: Client, bot: Bot):
-    """Encontra assinaturas vencidas, remove os usuários e atualiza o status."""
+async def _expiry_notice_job(bot: Bot, payload: dict):
+    """Job do outbox: avisa o usuário de que a assinatura expirou."""
     try:
-        now_iso = datetime.now(TIMEZONE_BR).isoformat()
+        await bot.send_message(chat_id=payload['telegram_user_id'], text="Sua assinatura expirou e seu acesso aos grupos foi removido. Para voltar, use o comando /renovar.")
+    except (Forbidden, BadRequest):
+        # Usuário bloqueou o bot ou a conta não existe mais: não adianta tentar de novo
+        logger.warning(f"Não foi possível enviar aviso de expiração para o usuário {payload['telegram_user_id']}.")
 
-        expired_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('id, user:users(telegram_user_id)')
-            .eq('status', 'active')
-            .lt('end_date', now_iso)
-            .execute()
-        )
 
-        if not expired_response.data:
-            logger.info("Nenhuma assinatura vencida encontrada.")
-            return
+# Os avisos cedem lugar às entregas de pagamento no rate limiter
+outbox.register('expiry_warning', _expiry_warning_job, rate_limiter.PRIORITY_BULK)
+outbox.register('expiry_notice', _expiry_notice_job, rate_limiter.PRIORITY_BULK)
+
+
+def _new_expiry_stats() -> dict:
+    return {"subscriptions": 0, "users": 0, "kicked_from": 0, "kick_failures": 0, "notices_queued": 0,
+            "kick_seconds": 0.0, "update_seconds": 0.0, "notice_seconds": 0.0}
+
+
+async def expire_subscriptions(supabase: AsyncPostgrestClient, bot: Bot, batch: list[dict], stats: dict | None = None) -> dict:
+    """
+    Expira um lote de assinaturas (cada uma com 'id' e 'user': {'telegram_user_id'}) em três etapas:
+    remoção dos grupos (pares usuário x grupo em paralelo), avisos gravados no outbox (uma
+    query) e marcação em massa como 'expired' (uma query `id IN (...)`). A marcação vem por
+    último e os avisos têm dedup_key por assinatura, então um lote interrompido pode ser
+    refeito sem duplicar nada.
+    Acumula as estatísticas em `stats`.
+    """
+    stats = stats if stats is not None else _new_expiry_stats()
+    sub_ids = [sub['id'] for sub in batch]
+    tg_user_by_sub = {
+        sub['id']: sub['user']['telegram_user_id'] for sub in batch if (sub.get('user') or {}).get('telegram_user_id')
+    }
+    # Um usuário pode ter mais de uma assinatura vencida; removemos cada um uma única vez
+    user_ids = list(dict.fromkeys(tg_user_by_sub.values()))
+    logger.info(f"Lote de {len(sub_ids)} assinaturas vencidas ({len(user_ids)} usuários) para processar.")
+
+    # Sem grupos (registro vazio ou falha no DB) ninguém seria removido: o lote fica 'active' para a próxima execução
+    if user_ids and not await group_registry.get_group_ids():
+        raise RuntimeError(f"Nenhum grupo cadastrado. Lote de {len(sub_ids)} assinatura(s) não expirado.")
+
+    # 1. Remove os usuários dos grupos (pares usuário x grupo em paralelo)
+    stage_started = time.perf_counter()
+    kick_result = await kick_users_from_all_groups(user_ids, bot)
+    stats["kick_seconds"] += time.perf_counter() - stage_started
 
-        logger.info(f"Encontradas {len(expired_response.data)} assinaturas vencidas para processar.")
+    # 2. Grava um aviso por usuário no outbox; o envio fica com os workers do outbox
+    stage_started = time.perf_counter()
+    first_sub_by_user = {}
+    for sub_id, user_id in tg_user_by_sub.items():
+        first_sub_by_user.setdefault(user_id, sub_id)
+    jobs = [('expiry_notice', {'telegram_user_id': user_id}, f"expired_notice:{sub_id}") for user_id, sub_id in first_sub_by_user.items()]
+    if jobs and not await outbox.enqueue_many(jobs):
+        # O lote não é marcado e volta na próxima execução
+        raise RuntimeError(f"Não foi possível enfileirar {len(jobs)} aviso(s) de expiração no outbox.")
+    stats["notice_seconds"] += time.perf_counter() - stage_started
 
-        for sub in expired_response.data:
-            user_id = sub.get('user', {}).get('telegram_user_id')
-            sub_id = sub.get('id')
+    # 3. Marca o lote inteiro como 'expired' em uma única query
+    stage_started = time.perf_counter()
+    await db.execute(
+        'scheduler_mark_expired',
+        supabase.table('subscriptions').update({'status': 'expired'}).in_('id', sub_ids).eq('status', 'active')
+    )
+    stats["update_seconds"] += time.perf_counter() - stage_started
 
-            if not user_id: continue
+    stats["subscriptions"] += len(sub_ids)
+    stats["users"] += len(user_ids)
+    stats["kicked_from"] += kick_result["removed"]
+    stats["kick_failures"] += kick_result["failed"]
+    stats["notices_queued"] += len(jobs)
+    return stats
 
-            logger.info(f"Processando expiração para o usuário {user_id} (assinatura {sub_id}).")
 
-            removed_count = await kick_user_from_all_groups(user_id, bot)
+async def find_and_process_expired_subscriptions(supabase: AsyncPostgrestClient, bot: Bot, shard_keys: list[int] | None = None,
+                                                 run: dict | None = None) -> dict:
+    """
+    Encontra assinaturas vencidas em lotes de EXPIRY_BATCH_SIZE e expira cada lote
+    com expire_subscriptions. Com `shard_keys`, processa só os buckets desses shards.
+    Com `run`, usa o corte de data da execução, grava um checkpoint por lote e retoma
+    do cursor salvo. Retorna as estatísticas da execução.
+    """
+    stats = _new_expiry_stats()
+    run_started = time.perf_counter()
+    cursor = run['cursor'] if run else {}
+    try:
+        now_iso = run['cutoff'] if run else datetime.now(TIMEZONE_BR).isoformat()
+        last_id = cursor.get('last_id') if cursor.get('phase') == 'expired' else None
 
-            await asyncio.to_thread(
-                lambda: supabase.table('subscriptions').update({'status': 'expired'}).eq('id', sub_id).execute()
+        while True:
+            if reason := _stop_reason():
+                stats[reason] = True
+                break
+            query = (
+                supabase.table('subscriptions')
+                .select('id, user:users(telegram_user_id)')
+                .eq('status', 'active')
+                .lt('end_date', now_iso)
             )
-            logger.info(f"Assinatura {sub_id} do usuário {user_id} marcada como 'expired'. Removido de {removed_count} grupos.")
-            try:
-                await bot.send_message(chat_id=user_id, text="Sua assinatura expirou e seu acesso aos grupos foi removido. Para voltar, use o comando /renovar.")
-            except (Forbidden, BadRequest):
-                pass
+            if shard_keys is not None:
+                query = query.in_('shard_key', shard_keys)
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            expired_response = await db.execute('scheduler_expired_batch', query.order('id').limit(EXPIRY_BATCH_SIZE))
+
+            batch = expired_response.data or []
+            if not batch:
+                break
+            last_id = batch[-1]['id']
+
+            await expire_subscriptions(supabase, bot, batch, stats)
+            if run:
+                await _checkpoint(supabase, run, {'phase': 'expired', 'last_id': last_id}, processed=len(batch), stats=stats)
+
+            if len(batch) < EXPIRY_BATCH_SIZE:
+                break
+
+        if not stats["subscriptions"]:
+            logger.info("Nenhuma assinatura vencida encontrada.")
     except Exception as e:
         logger.error(f"Erro CRÍTICO no processo de expiração: {e}", exc_info=True)
+        stats["error"] = str(e)
+
+    elapsed = time.perf_counter() - run_started
+    stats["total_seconds"] = round(elapsed, 3)
+    stats["users_per_second"] = round(stats["users"] / elapsed, 2) if elapsed > 0 else 0.0
+    for key in ("kick_seconds", "update_seconds", "notice_seconds"):
+        stats[key] = round(stats[key], 3)
+    if stats["subscriptions"]:
+        logger.info(f"Expiração concluída: {stats}")
+    return stats
+
+
+# --- EXECUÇÕES COM CHECKPOINT (migrations/007_scheduler_runs.sql) ---
+
+def _sum_stats(base: dict, current: dict) -> dict:
+    """Soma as estatísticas numéricas de uma execução retomada às registradas antes da interrupção."""
+    merged = dict(base)
+    for key, value in current.items():
+        if isinstance(value, (int, float)) and isinstance(merged.get(key), (int, float)):
+            merged[key] = round(merged[key] + value, 3)
+        else:
+            merged[key] = value
+    return merged
+
+
+async def _open_run(supabase: AsyncPostgrestClient, scope: str, shard_keys: list[int] | None) -> dict:
+    """
+    Retoma a execução inacabada do escopo ('global' ou 'shard:<i>') ou registra uma nova,
+    com o corte de data e o total de assinaturas vencidas a processar.
+    """
+    now_iso = datetime.now(TIMEZONE_BR).isoformat()
+    response = await db.execute(
+        'scheduler_find_open_run',
+        supabase.table('scheduler_runs').select('*').eq('scope', scope).eq('state', 'running').limit(1)
+    )
+    if response.data:
+        run = response.data[0]
+        await db.execute(
+            'scheduler_resume_run',
+            supabase.table('scheduler_runs').update({'holder': leases.INSTANCE_ID, 'updated_at': now_iso}).eq('id', run['id'])
+        )
+        logger.info(f"Retomando execução {run['id']} do scheduler ({scope}) a partir de {run['cursor']} ({run['processed']}/{run['total']}).")
+        return {**run, 'resumed': True}
+
+    count_query = (
+        supabase.table('subscriptions')
+        .select('id', count=CountMethod.exact)
+        .eq('status', 'active')
+        .lt('end_date', now_iso)
+    )
+    if shard_keys is not None:
+        count_query = count_query.in_('shard_key', shard_keys)
+    total = (await db.execute('scheduler_count_expired', count_query.limit(1))).count or 0
+
+    response = await db.execute(
+        'scheduler_open_run',
+        supabase.table('scheduler_runs').insert({
+            'scope': scope, 'holder': leases.INSTANCE_ID, 'cutoff': now_iso, 'total': total,
+        })
+    )
+    return {**response.data[0], 'resumed': False}
+
+
+async def _checkpoint(supabase: AsyncPostgrestClient, run: dict, cursor: dict, processed: int = 0, stats: dict | None = None):
+    """
+    Grava o cursor (último lote concluído), o progresso e as estatísticas parciais da execução.
+    As estatísticas desta sessão ficam em memória por fase e são somadas às salvas na abertura
+    (run['stats']), então o checkpoint de uma fase não apaga o que a outra já gravou.
+    """
+    run['cursor'] = cursor
+    run['processed'] += processed
+    update = {'cursor': cursor, 'processed': run['processed'], 'updated_at': datetime.now(TIMEZONE_BR).isoformat()}
+    if stats is not None:
+        session_stats = run.setdefault('session_stats', {})
+        session_stats[cursor['phase']] = dict(stats)
+        update['stats'] = {
+            **run['stats'],
+            **{phase: _sum_stats(run['stats'].get(phase, {}), phase_stats) for phase, phase_stats in session_stats.items()},
+        }
+    await db.execute('scheduler_checkpoint', supabase.table('scheduler_runs').update(update).eq('id', run['id']))
+
+
+async def _finish_run(supabase: AsyncPostgrestClient, run: dict, warnings: dict, expired: dict):
+    now_iso = datetime.now(TIMEZONE_BR).isoformat()
+    await db.execute(
+        'scheduler_finish_run',
+        supabase.table('scheduler_runs').update({
+            'state': 'done',
+            'stats': {'warnings': _sum_stats(run['stats'].get('warnings', {}), warnings),
+                      'expired': _sum_stats(run['stats'].get('expired', {}), expired)},
+            'updated_at': now_iso,
+            'finished_at': now_iso,
+        }).eq('id', run['id'])
+    )
+
+
+async def _run_scope(supabase: AsyncPostgrestClient, bot: Bot, scope: str, shard_keys: list[int] | None) -> dict:
+    """
+    Executa avisos + expirações de um escopo com checkpoints. Execuções com erro,
+    com o tempo esgotado ou que perderam o lease/shard ficam abertas para retomada.
+    """
+    try:
+        run = await _open_run(supabase, scope, shard_keys)
+    except Exception as e:
+        # Sem o registro da execução (ex.: DB instável), processa mesmo assim, só que sem checkpoints
+        logger.error(f"Não foi possível registrar a execução do scheduler ({scope}): {e}", exc_info=True)
+        run = None
+    warnings = await find_and_process_expiring_subscriptions(supabase, bot, shard_keys, run)
+    stopped = any(key in warnings for key in _STOP_REASONS)
+    expired = await find_and_process_expired_subscriptions(supabase, bot, shard_keys, run) if not stopped else {}
+    incomplete = any(key in stats for stats in (warnings, expired) for key in ("error", *_STOP_REASONS))
+    if run and not incomplete:
+        await _finish_run(supabase, run, warnings, expired)
+    return {"run_id": run['id'] if run else None, "resumed": run['resumed'] if run else False,
+            "warnings": warnings, "expired": expired}
+
+
+async def get_recent_runs(supabase: AsyncPostgrestClient, limit: int = 20) -> list[dict]:
+    """Últimas execuções registradas, com processadas/restantes e vazão (assinaturas por segundo)."""
+    response = await db.execute(
+        'scheduler_recent_runs',
+        supabase.table('scheduler_runs').select('*').order('id', desc=True).limit(limit)
+    )
+    runs = []
+    for run in response.data or []:
+        elapsed = (datetime.fromisoformat(run['updated_at']) - datetime.fromisoformat(run['started_at'])).total_seconds()
+        runs.append({
+            **run,
+            'remaining': max((run['total'] or 0) - run['processed'], 0),
+            'per_second': round(run['processed'] / elapsed, 2) if elapsed > 0 else 0.0,
+        })
+    return runs
+
+
+# --- EXECUÇÃO ÚNICA (single-flight) ---
+# Nome do lease que garante uma única execução entre todas as instâncias (modo sem shards)
+SCHEDULER_LEASE_NAME = "scheduler_run"
+# Intervalo da execução periódica em cada instância (0 = só via /webhook/run-scheduler).
+# Com SCHEDULER_SHARDS > 1, cada instância processa apenas os seus shards.
+SCHEDULER_INTERVAL_SECONDS = float(os.getenv("SCHEDULER_INTERVAL_SECONDS", 0))
+# Intervalo usado quando há shards mas SCHEDULER_INTERVAL_SECONDS não foi definido
+SCHEDULER_SHARDED_DEFAULT_INTERVAL_SECONDS = 300.0
+
+_run_task: asyncio.Task | None = None
+_periodic_task: asyncio.Task | None = None
+_run_status: dict = {"state": "idle", "holder": leases.INSTANCE_ID, "started_at": None, "finished_at": None,
+                     "shards": None, "triggers": 0, "coalesced": 0, "last_result": None}
+
+
+def get_run_status() -> dict:
+    """Estado da execução do scheduler nesta instância (em andamento ou a última concluída)."""
+    return dict(_run_status)
+
+
+async def _run(supabase: AsyncPostgrestClient, bot: Bot, shard_keys: list[int] | None):
+    global _lease_lost, _scope_shard
+    # Sem shards, a execução é global e protegida pelo lease; com shards, os leases dos shards já garantem a exclusividade
+    lease = leases.keep_alive(SCHEDULER_LEASE_NAME) if shard_keys is None else contextlib.nullcontext()
+    async with lease as lease_lost:
+        _lease_lost = lease_lost
+        try:
+            logger.info("--- Iniciando verificação do scheduler ---")
+            # Cada shard tem sua própria execução com checkpoint, retomável por qualquer instância que o assuma
+            if shard_keys is None:
+                scopes = [("global", None, None)]
+            else:
+                scopes = [(f"shard:{shard}", shard, shards.bucket_keys([shard])) for shard in shards.owned_shards()]
+            results = {}
+            for scope, shard, scope_keys in scopes:
+                # Shard repassado a outra instância antes de chegar a vez dele: a nova dona o processa
+                if shard is not None and not shards.owns_shard(shard):
+                    results[scope] = {"run_id": None, "resumed": False, "warnings": {"shard_lost": True}, "expired": {}}
+                    continue
+                _scope_shard = shard
+                results[scope] = await _run_scope(supabase, bot, scope, scope_keys)
+            _run_status.update(state="idle", last_result=results)
+            logger.info("--- Verificação do scheduler concluída ---")
+        except BaseException as e:
+            _run_status.update(state="failed", last_result={"error": str(e)})
+            raise
+        finally:
+            _lease_lost = None
+            _scope_shard = None
+            _run_status["finished_at"] = datetime.now(TIMEZONE_BR).isoformat()
+
+
+async def trigger_run(supabase: AsyncPostgrestClient, bot: Bot) -> tuple[bool, dict]:
+    """
+    Inicia uma execução (avisos + expirações) em segundo plano, a menos que já haja
+    uma em andamento, aqui ou em outra instância (lease no DB). Disparos sobrepostos
+    são agrupados na execução corrente. Com SCHEDULER_SHARDS > 1 a execução cobre
+    apenas os shards desta instância. Retorna (iniciou, status).
+    """
+    global _run_task
+    _run_status["triggers"] += 1
+    if _run_task is not None and not _run_task.done():
+        _run_status["coalesced"] += 1
+        return False, get_run_status()
+
+    shard_keys = shards.owned_bucket_keys()
+    if shard_keys is not None:
+        if not shard_keys:
+            return False, {**get_run_status(), "state": "no_shards"}
+    elif not await leases.acquire(SCHEDULER_LEASE_NAME):
+        _run_status["coalesced"] += 1
+        return False, {**get_run_status(), "state": "running_elsewhere", "lease": await db.get_lease(SCHEDULER_LEASE_NAME)}
+    # Outro disparo pode ter iniciado a execução enquanto aguardávamos o DB
+    if _run_task is not None and not _run_task.done():
+        _run_status["coalesced"] += 1
+        return False, get_run_status()
+
+    _run_status.update(state="running", started_at=datetime.now(TIMEZONE_BR).isoformat(), finished_at=None,
+                       shards=shards.owned_shards() if shard_keys is not None else None)
+    _run_task = asyncio.create_task(_run(supabase, bot, shard_keys))
+    return True, get_run_status()
+
+
+async def _periodic_loop(supabase: AsyncPostgrestClient, bot: Bot):
+    while True:
+        await asyncio.sleep(SCHEDULER_INTERVAL_SECONDS)
+        try:
+            await trigger_run(supabase, bot)
+        except Exception as e:
+            logger.error(f"Erro ao disparar a execução periódica do scheduler: {e}", exc_info=True)
+
+
+async def start(supabase: AsyncPostgrestClient, bot: Bot):
+    """
+    Inicia a execução periódica, se SCHEDULER_INTERVAL_SECONDS estiver definido. Chamado no startup.
+    Com SCHEDULER_SHARDS > 1 ela é obrigatória: o /webhook/run-scheduler só varre os shards da
+    instância que o recebe e a CLI se recusa a rodar, então sem ela a maioria dos shards nunca seria varrida.
+    """
+    global _periodic_task, SCHEDULER_INTERVAL_SECONDS
+    if SCHEDULER_INTERVAL_SECONDS <= 0 and shards.is_sharded():
+        logger.error(f"SCHEDULER_SHARDS > 1 exige SCHEDULER_INTERVAL_SECONDS > 0. Usando {SCHEDULER_SHARDED_DEFAULT_INTERVAL_SECONDS:.0f}s.")
+        SCHEDULER_INTERVAL_SECONDS = SCHEDULER_SHARDED_DEFAULT_INTERVAL_SECONDS
+    if SCHEDULER_INTERVAL_SECONDS <= 0:
+        return
+    if _periodic_task is None or _periodic_task.done():
+        _periodic_task = asyncio.create_task(_periodic_loop(supabase, bot))
+
+
+async def stop():
+    """Cancela a execução periódica e a execução em andamento. Chamado no shutdown."""
+    global _periodic_task
+    for task in (_periodic_task, _run_task):
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _periodic_task = None
+
+
+# --- EXECUÇÃO AVULSA: python -m scheduler ---
+
+async def estimate_run(supabase: AsyncPostgrestClient, shard_keys: list[int] | None = None) -> dict:
+    """
+    Simulação (--dry-run): conta o que seria avisado e removido agora, sem chamar o
+    Telegram nem gravar no DB, e estima a duração pelos limites da Bot API.
+    """
+    now = datetime.now(TIMEZONE_BR)
+    warnings = {}
+    for days in EXPIRY_WARNING_THRESHOLDS:
+        query = (
+            supabase.table('subscriptions')
+            .select('id, notifications!left(id)', count=CountMethod.exact)
+            .eq('status', 'active')
+            .gt('end_date', now.isoformat())
+            .lte('end_date', (now + timedelta(days=days)).isoformat())
+            .eq('notifications.notice_type', warning_notice_type(days))
+            .is_('notifications', 'null')
+        )
+        if shard_keys is not None:
+            query = query.in_('shard_key', shard_keys)
+        # Uma assinatura pode aparecer em mais de um limiar, mas recebe um único aviso por execução
+        warnings[warning_notice_type(days)] = (await db.execute('scheduler_estimate_warnings', query.limit(1))).count or 0
+
+    user_ids: list[int] = []
+    subscriptions = 0
+    last_id = None
+    while True:
+        query = (
+            supabase.table('subscriptions')
+            .select('id, user:users(telegram_user_id)')
+            .eq('status', 'active')
+            .lt('end_date', now.isoformat())
+        )
+        if shard_keys is not None:
+            query = query.in_('shard_key', shard_keys)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        batch = (await db.execute('scheduler_estimate_expired', query.order('id').limit(EXPIRY_BATCH_SIZE))).data or []
+        subscriptions += len(batch)
+        user_ids.extend(sub['user']['telegram_user_id'] for sub in batch if (sub.get('user') or {}).get('telegram_user_id'))
+        if len(batch) < EXPIRY_BATCH_SIZE:
+            break
+        last_id = batch[-1]['id']
+    user_ids = list(dict.fromkeys(user_ids))
+
+    group_ids = await group_registry.get_group_ids()
+    pairs = [(user_id, group_id) for user_id in user_ids for group_id in group_ids]
+    api_calls = len(pairs) + len(user_ids) + sum(warnings.values())
+    return {
+        "warnings": warnings,
+        "expired_subscriptions": subscriptions,
+        "users_to_kick": user_ids,
+        "groups": len(group_ids),
+        "kick_calls": len(pairs),
+        "api_calls": api_calls,
+        # Estimativa conservadora nos avisos e limite inferior no tempo: tudo passa pelo limite global do bot
+        "estimated_seconds": round(api_calls / rate_limiter.TELEGRAM_GLOBAL_RATE, 1),
+    }
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m scheduler", description="Executa os avisos de vencimento e as expirações fora do processo web. Os avisos são gravados no outbox e enviados pelos workers das instâncias web.")
+    parser.add_argument("--batch-size", type=int, default=EXPIRY_BATCH_SIZE, help="assinaturas por lote (padrão: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=KICK_CONCURRENCY, help="remoções (usuário, grupo) simultâneas (padrão: %(default)s)")
+    parser.add_argument("--time-budget", type=float, default=0, help="segundos até parar entre lotes; a execução é retomada na próxima vez (0 = sem limite)")
+    parser.add_argument("--dry-run", action="store_true", help="só mostra o que seria avisado/removido e a duração estimada")
+    return parser.parse_args(argv)
+
+
+async def _main(args: argparse.Namespace) -> int:
+    global EXPIRY_BATCH_SIZE, KICK_CONCURRENCY, _deadline
+    EXPIRY_BATCH_SIZE = args.batch_size
+    KICK_CONCURRENCY = args.concurrency
+
+    try:
+        if args.dry_run:
+            result = await estimate_run(db.supabase)
+            print(json.dumps(result, indent=2, default=str))
+            return 0
+
+        if shards.is_sharded():
+            logger.error("Com SCHEDULER_SHARDS > 1 os shards pertencem às instâncias (SCHEDULER_INTERVAL_SECONDS). Use --dry-run ou SCHEDULER_SHARDS=1.")
+            return 2
+        if not await leases.acquire(SCHEDULER_LEASE_NAME):
+            logger.warning(f"Já existe uma execução em andamento: {await db.get_lease(SCHEDULER_LEASE_NAME)}")
+            return 1
+
+        # Evita regravar no índice de membros pares cujo status não mudou
+        await membership.load()
+        if args.time_budget > 0:
+            _deadline = time.monotonic() + args.time_budget
+        bot = ExtBot(TELEGRAM_BOT_TOKEN, rate_limiter=rate_limiter.TelegramRateLimiter())
+        async with bot:
+            await _run(db.supabase, bot, None)
+        print(json.dumps(get_run_status(), indent=2, default=str))
+        if _run_status["state"] != "idle":
+            return 1
+        # Erros nos passes ficam só nas estatísticas; o código de saída os expõe ao cron/monitoramento
+        failed = any(
+            "error" in pass_stats or "lease_lost" in pass_stats
+            for scope in (_run_status["last_result"] or {}).values()
+            for pass_stats in (scope["warnings"], scope["expired"])
+        )
+        return 1 if failed else 0
+    finally:
+        await db.close()
 
 
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(_parse_args())))
@@ -0,0 +1,159 @@
+# --- START OF FILE shards.py ---
+
+import os
+import math
+import asyncio
+import logging
+
+import db_supabase as db
+import leases
+
+logger = logging.getLogger(__name__)
+
+# Número de shards do scheduler. Com 1 (padrão) não há particionamento nem leases por shard.
+SCHEDULER_SHARDS = max(int(os.getenv("SCHEDULER_SHARDS", 1)), 1)
+# Buckets de subscriptions.shard_key (mesmo valor de migrations/006_subscription_shards.sql)
+SHARD_BUCKETS = 1024
+SHARD_LEASE_PREFIX = "scheduler_shard:"
+INSTANCE_LEASE_PREFIX = "scheduler_instance:"
+
+_owned: set[int] = set() if SCHEDULER_SHARDS > 1 else {0}
+# Callbacks async (ganhos, perdidos) chamados quando os shards desta instância mudam
+_listeners: list = []
+_rebalance_task: asyncio.Task | None = None
+_stats = {"rebalances": 0, "acquired": 0, "released": 0, "lost": 0, "instances": 1}
+
+
+def is_sharded() -> bool:
+    return SCHEDULER_SHARDS > 1
+
+
+def shard_of(db_user_id: int) -> int:
+    """Shard de um usuário (pelo ID interno do DB), consistente com subscriptions.shard_key."""
+    return (db_user_id % SHARD_BUCKETS) % SCHEDULER_SHARDS
+
+
+def owns_user(db_user_id: int) -> bool:
+    return shard_of(db_user_id) in _owned
+
+
+def owns_shard(shard: int) -> bool:
+    return shard in _owned
+
+
+def owned_shards() -> list[int]:
+    return sorted(_owned)
+
+
+def bucket_keys(shard_ids) -> list[int]:
+    """Valores de subscriptions.shard_key que pertencem aos shards informados."""
+    shard_ids = set(shard_ids)
+    return [bucket for bucket in range(SHARD_BUCKETS) if bucket % SCHEDULER_SHARDS in shard_ids]
+
+
+def owned_bucket_keys() -> list[int] | None:
+    """Filtro de shard_key para as queries desta instância; None quando não há particionamento."""
+    return bucket_keys(_owned) if is_sharded() else None
+
+
+def add_listener(callback):
+    """Registra um callback async(ganhos, perdidos) chamado a cada mudança nos shards desta instância."""
+    _listeners.append(callback)
+
+
+def _shard_from_lease(name: str) -> int:
+    return int(name[len(SHARD_LEASE_PREFIX):])
+
+
+async def rebalance() -> tuple[set[int], set[int]]:
+    """
+    Renova os leases desta instância e ajusta quantos shards ela detém para a sua
+    parte justa (ceil(shards / instâncias vivas)): libera o excedente e assume shards
+    livres ou cujo dono morreu (lease expirado). Retorna (ganhos, perdidos).
+    """
+    if not is_sharded():
+        return set(), set()
+    _stats["rebalances"] += 1
+    await leases.acquire(f"{INSTANCE_LEASE_PREFIX}{leases.INSTANCE_ID}")
+    instances = {lease['holder'] for lease in await db.list_active_leases(INSTANCE_LEASE_PREFIX)}
+    instances.add(leases.INSTANCE_ID)
+    _stats["instances"] = len(instances)
+    fair_share = math.ceil(SCHEDULER_SHARDS / len(instances))
+
+    gained, lost = set(), set()
+    for shard in sorted(_owned):
+        if not await leases.acquire(f"{SHARD_LEASE_PREFIX}{shard}"):
+            lost.add(shard)
+            _stats["lost"] += 1
+    _owned.difference_update(lost)
+
+    while len(_owned) > fair_share:
+        shard = max(_owned)
+        await leases.release(f"{SHARD_LEASE_PREFIX}{shard}")
+        _owned.discard(shard)
+        lost.add(shard)
+        _stats["released"] += 1
+
+    if len(_owned) < fair_share:
+        taken = {_shard_from_lease(lease['name']) for lease in await db.list_active_leases(SHARD_LEASE_PREFIX)}
+        for shard in range(SCHEDULER_SHARDS):
+            if len(_owned) >= fair_share:
+                break
+            if shard in taken or shard in _owned:
+                continue
+            if await leases.acquire(f"{SHARD_LEASE_PREFIX}{shard}"):
+                _owned.add(shard)
+                gained.add(shard)
+                _stats["acquired"] += 1
+
+    if gained or lost:
+        logger.info(f"[SHARDS] Shards desta instância: {owned_shards()} (+{sorted(gained)} -{sorted(lost)}, {len(instances)} instância(s)).")
+        for callback in _listeners:
+            try:
+                await callback(gained, lost)
+            except Exception as e:
+                logger.error(f"[SHARDS] Erro ao notificar mudança de shards: {e}", exc_info=True)
+    return gained, lost
+
+
+async def _rebalance_loop():
+    while True:
+        await asyncio.sleep(leases.LEASE_TTL_SECONDS / 3)
+        try:
+            await rebalance()
+        except Exception as e:
+            logger.error(f"[SHARDS] Erro ao rebalancear shards: {e}", exc_info=True)
+
+
+async def start():
+    """Assume a parte inicial dos shards e inicia o rebalanceamento periódico. Chamado no startup."""
+    global _rebalance_task
+    if not is_sharded():
+        return
+    await rebalance()
+    if _rebalance_task is None or _rebalance_task.done():
+        _rebalance_task = asyncio.create_task(_rebalance_loop())
+
+
+async def stop():
+    """Libera os shards e o lease da instância para que as outras assumam já. Chamado no shutdown."""
+    global _rebalance_task
+    if _rebalance_task:
+        _rebalance_task.cancel()
+        try:
+            await _rebalance_task
+        except asyncio.CancelledError:
+            pass
+        _rebalance_task = None
+    if not is_sharded():
+        return
+    for shard in list(_owned):
+        await leases.release(f"{SHARD_LEASE_PREFIX}{shard}")
+    _owned.clear()
+    await leases.release(f"{INSTANCE_LEASE_PREFIX}{leases.INSTANCE_ID}")
+    logger.info(f"[SHARDS] Shards liberados: {get_stats()}")
+
+
+def get_stats() -> dict:
+    """Retorna os shards desta instância e os contadores de rebalanceamento."""
+    return {**_stats, "shards": SCHEDULER_SHARDS, "owned": owned_shards()}
@@ -0,0 +1,131 @@
+# --- START OF FILE update_workers.py ---
+
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Workers que processam as atualizações do webhook e tamanho total da fila (dividido entre eles)
+TELEGRAM_UPDATE_WORKERS = max(int(os.getenv("TELEGRAM_UPDATE_WORKERS", 8)), 1)
+TELEGRAM_UPDATE_QUEUE_SIZE = int(os.getenv("TELEGRAM_UPDATE_QUEUE_SIZE", 1000))
+# Quanto o webhook espera por espaço na fila antes de responder 503 (o Telegram reenvia depois)
+TELEGRAM_ENQUEUE_TIMEOUT = float(os.getenv("TELEGRAM_ENQUEUE_TIMEOUT", 1.0))
+TELEGRAM_DRAIN_TIMEOUT = float(os.getenv("TELEGRAM_DRAIN_TIMEOUT", 10.0))
+# Quantos update_id recentes são lembrados para descartar reenvios do Telegram
+TELEGRAM_UPDATE_DEDUP_SIZE = int(os.getenv("TELEGRAM_UPDATE_DEDUP_SIZE", 10000))
+
+# Uma fila por worker: atualizações do mesmo usuário vão sempre para o mesmo worker, em ordem
+_queues: list[asyncio.Queue] = []
+_workers: list[asyncio.Task] = []
+# LRU dos update_id já aceitos
+_recent_update_ids: OrderedDict[int, None] = OrderedDict()
+_stats = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0, "duplicates": 0, "max_depth": 0}
+
+
+def _seen(update_id: int | None) -> bool:
+    """Registra o update_id e diz se ele já tinha sido aceito recentemente."""
+    if update_id is None:
+        return False
+    if update_id in _recent_update_ids:
+        _recent_update_ids.move_to_end(update_id)
+        return True
+    _recent_update_ids[update_id] = None
+    if len(_recent_update_ids) > TELEGRAM_UPDATE_DEDUP_SIZE:
+        _recent_update_ids.popitem(last=False)
+    return False
+
+
+def _ordering_key(data: dict) -> int:
+    """Usuário (ou chat) da atualização, lido do JSON bruto; sem nenhum dos dois, o próprio update_id."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user_id = (value.get('from') or {}).get('id')
+        if user_id:
+            return user_id
+        chat_id = (value.get('chat') or {}).get('id')
+        if chat_id:
+            return chat_id
+    return data.get('update_id', 0)
+
+
+async def enqueue(data: dict) -> bool:
+    """
+    Coloca uma atualização (JSON bruto do webhook) na fila do worker do seu usuário.
+    Reenvios de um update_id já aceito são descartados antes de qualquer
+    processamento (e confirmados ao Telegram). Retorna False se a fila continuar
+    cheia após TELEGRAM_ENQUEUE_TIMEOUT (backpressure).
+    """
+    update_id = data.get('update_id')
+    if _seen(update_id):
+        _stats["duplicates"] += 1
+        logger.info(f"[UPDATES] Atualização {update_id} repetida. Descartando.")
+        return True
+
+    queue = _queues[_ordering_key(data) % len(_queues)]
+    try:
+        await asyncio.wait_for(queue.put(data), timeout=TELEGRAM_ENQUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Não foi aceita: o reenvio do Telegram deve ser processado normalmente
+        _recent_update_ids.pop(update_id, None)
+        _stats["rejected"] += 1
+        logger.warning(f"[UPDATES] Fila cheia ({get_depth()} atualizações). Recusando a atualização {data.get('update_id')}.")
+        return False
+    _stats["enqueued"] += 1
+    _stats["max_depth"] = max(_stats["max_depth"], get_depth())
+    return True
+
+
+async def _worker(application: Application, queue: asyncio.Queue):
+    while True:
+        data = await queue.get()
+        try:
+            update = Update.de_json(data, application.bot)
+            await application.process_update(update)
+            _stats["processed"] += 1
+        except Exception as e:
+            _stats["failed"] += 1
+            logger.error(f"[UPDATES] Erro ao processar a atualização {data.get('update_id')}: {e}", exc_info=True)
+        finally:
+            queue.task_done()
+
+
+async def start(application: Application):
+    """Cria as filas e inicia os workers. Chamado no startup, depois de application.start()."""
+    if _workers:
+        return
+    maxsize = max(TELEGRAM_UPDATE_QUEUE_SIZE // TELEGRAM_UPDATE_WORKERS, 1)
+    for _ in range(TELEGRAM_UPDATE_WORKERS):
+        queue = asyncio.Queue(maxsize=maxsize)
+        _queues.append(queue)
+        _workers.append(asyncio.create_task(_worker(application, queue)))
+    logger.info(f"[UPDATES] {TELEGRAM_UPDATE_WORKERS} workers de atualizações iniciados (fila de {maxsize} por worker).")
+
+
+async def stop():
+    """Espera as filas esvaziarem (até TELEGRAM_DRAIN_TIMEOUT) e encerra os workers. Chamado no shutdown."""
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in _queues)), timeout=TELEGRAM_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"[UPDATES] Encerrando com {get_depth()} atualização(ões) ainda na fila.")
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queues.clear()
+    logger.info(f"[UPDATES] Workers encerrados: {get_stats()}")
+
+
+def get_depth() -> int:
+    """Total de atualizações aguardando processamento."""
+    return sum(queue.qsize() for queue in _queues)
+
+
+def get_stats() -> dict:
+    """Retorna a profundidade da fila (total e por worker) e os contadores de processamento."""
+    return {**_stats, "depth": get_depth(), "per_worker": [queue.qsize() for queue in _queues]}
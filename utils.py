@@ -1,20 +1,29 @@
 # --- START OF FILE utils.py ---
 
+import os
+import time
 import logging
 import asyncio
 from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator
 
 from telegram import Bot
 from telegram.ext import Application
 from telegram.constants import ParseMode
 
-import db_supabase as db
+import group_registry
+import invite_pool
+import membership
+import rate_limiter
 
 logger = logging.getLogger(__name__)
 
 # --- Carrega o fuso horário uma vez ---
 TIMEZONE_BR = timezone(timedelta(hours=-3))
 
+# Quantos grupos são processados em paralelo ao enviar links de acesso
+ACCESS_LINKS_CONCURRENCY = int(os.getenv("ACCESS_LINKS_CONCURRENCY", 5))
+
 def format_date_br(dt: datetime | str | None) -> str:
     """Formata data para o padrão brasileiro."""
     if not dt:
@@ -24,63 +33,112 @@ def format_date_br(dt: datetime | str | None) -> str:
     return dt.astimezone(TIMEZONE_BR).strftime('%d/%m/%Y às %H:%M')
 
 
-async def send_access_links(bot: Bot, user_id: int, payment_id: str, is_support_request: bool = False):
+async def run_bounded(items, worker, concurrency: int) -> list:
+    """Executa worker(item) para cada item com no máximo `concurrency` chamadas simultâneas."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await worker(item)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+_STREAM_END = object()
+
+async def run_bounded_stream(items: AsyncIterator, worker, concurrency: int):
+    """
+    Como run_bounded, mas consome um iterador assíncrono aos poucos (sem carregá-lo
+    inteiro na memória), com `concurrency` workers. Erros do worker são apenas logados.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                return
+            try:
+                await worker(item)
+            except Exception as e:
+                logger.error(f"Erro ao processar item {item}: {e}", exc_info=True)
+
+    consumers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+    try:
+        async for item in items:
+            await queue.put(item)
+    finally:
+        for _ in consumers:
+            await queue.put(_STREAM_END)
+        await asyncio.gather(*consumers)
+
+
+async def _create_group_link(bot: Bot, chat_id: int, position: int, expire_date: datetime) -> tuple[str, str]:
+    # Usa um link pré-criado do pool; só chama a API se o pool do grupo estiver vazio
+    invite_link = invite_pool.take(chat_id)
+    if not invite_link:
+        link = await bot.create_chat_invite_link(chat_id=chat_id, expire_date=expire_date, member_limit=1)
+        invite_link = link.invite_link
+    # O título vem do cache de metadados (sem chamada a get_chat)
+    return group_registry.get_title(chat_id) or f"Grupo {position}", invite_link
+
+
+async def _process_group_access(bot: Bot, chat_id: int, position: int, user_id: int, payment_id: str, expire_date: datetime, use_index: bool = True) -> dict:
+    """Verifica a participação do usuário em um grupo e gera o link se necessário."""
+    started = time.perf_counter()
+    result = {"chat_id": chat_id, "status": "failed", "title": None, "link": None}
+    try:
+        # Consulta o índice de membros (get_chat_member só quando o par é desconhecido)
+        if await membership.is_member(bot, chat_id, user_id, use_index=use_index):
+            result.update(status="member", title=group_registry.get_title(chat_id) or f"Grupo {position}")
+        else:
+            # O usuário não é membro, então geramos o link.
+            title, invite_link = await _create_group_link(bot, chat_id, position, expire_date)
+            result.update(status="link", title=title, link=invite_link)
+    except Exception as e:
+        logger.error(f"[JOB][{payment_id}] Erro ao verificar membro ou criar link para o grupo {chat_id}: {e}")
+
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+async def send_access_links(bot: Bot, user_id: int, payment_id: str, is_support_request: bool = False) -> dict | None:
+    """Envia os links de acesso com prioridade máxima no rate limiter (veja _send_access_links)."""
+    with rate_limiter.priority(rate_limiter.PRIORITY_PAYMENT):
+        return await _send_access_links(bot, user_id, payment_id, is_support_request)
+
+
+async def _send_access_links(bot: Bot, user_id: int, payment_id: str, is_support_request: bool) -> dict | None:
     """
     Gera e envia links de acesso, verificando se o usuário já é membro.
     O parâmetro 'is_support_request' diferencia uma compra nova de um pedido de suporte.
+    Os grupos são processados em paralelo (até ACCESS_LINKS_CONCURRENCY por vez) e a
+    mensagem final só é montada quando todos terminam. Retorna o resultado de cada grupo
+    (status, título, link e tempo gasto) ou None se não houver grupos cadastrados.
     """
     logger.info(f"[JOB][{payment_id}] Iniciando tarefa para enviar links ao usuário {user_id}.")
+    started = time.perf_counter()
 
-    group_ids = await db.get_all_group_ids()
+    group_ids = await group_registry.get_group_ids()
     if not group_ids:
         logger.error(f"CRÍTICO: Nenhum grupo encontrado no DB para enviar links ao usuário {user_id}.")
         await bot.send_message(chat_id=user_id, text="⚠️ Tivemos um problema interno para buscar os grupos. Nossa equipe foi notificada.")
-        return
+        return None
 
-    links_to_send_text = ""
-    groups_already_in_text = ""
-    failed_links = 0
-    new_links_generated = 0
     expire_date = datetime.now(timezone.utc) + timedelta(hours=2)
-
-    for chat_id in group_ids:
-        try:
-            # --- NOVA LÓGICA DE VERIFICAÇÃO DE MEMBRO ---
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                chat = await bot.get_chat(chat_id)
-                groups_already_in_text += f"✅ Você já é membro do grupo: *{chat.title}*\n"
-                continue # Pula para o próximo grupo
-            # ----------------------------------------------
-
-            # Se chegou aqui, o usuário não é membro, então geramos o link.
-            link = await bot.create_chat_invite_link(
-                chat_id=chat_id,
-                expire_date=expire_date,
-                member_limit=1
-            )
-            chat = await bot.get_chat(chat_id)
-            group_title = chat.title or f"Grupo {group_ids.index(chat_id) + 1}"
-            links_to_send_text += f"🔗 *{group_title}:* {link.invite_link}\n"
-            new_links_generated += 1
-
-        except Exception as e:
-            if "user not found" in str(e).lower(): # O usuário não está no grupo, o que é esperado
-                try:
-                    # Tentamos gerar o link mesmo assim
-                    link = await bot.create_chat_invite_link(chat_id=chat_id, expire_date=expire_date, member_limit=1)
-                    chat = await bot.get_chat(chat_id)
-                    group_title = chat.title or f"Grupo {group_ids.index(chat_id) + 1}"
-                    links_to_send_text += f"🔗 *{group_title}:* {link.invite_link}\n"
-                    new_links_generated += 1
-                except Exception as inner_e:
-                     logger.error(f"[JOB][{payment_id}] Erro interno ao criar link para o grupo {chat_id}: {inner_e}")
-                     failed_links += 1
-            else:
-                logger.error(f"[JOB][{payment_id}] Erro ao verificar membro ou criar link para o grupo {chat_id}: {e}")
-                failed_links += 1
-
-        await asyncio.sleep(0.2) # Evita rate limiting
+    positions = {chat_id: position for position, chat_id in enumerate(group_ids, start=1)}
+    group_results = await run_bounded(
+        group_ids,
+        # Em pedidos de suporte confirmamos a participação direto na API
+        lambda chat_id: _process_group_access(bot, chat_id, positions[chat_id], user_id, payment_id, expire_date, use_index=not is_support_request),
+        ACCESS_LINKS_CONCURRENCY,
+    )
+
+    links_to_send_text = "".join(f"🔗 *{r['title']}:* {r['link']}\n" for r in group_results if r['status'] == 'link')
+    groups_already_in_text = "".join(f"✅ Você já é membro do grupo: *{r['title']}*\n" for r in group_results if r['status'] == 'member')
+    new_links_generated = sum(1 for r in group_results if r['status'] == 'link')
+    already_member = sum(1 for r in group_results if r['status'] == 'member')
+    failed_links = sum(1 for r in group_results if r['status'] == 'failed')
 
     # --- LÓGICA DE MENSAGEM FINAL APRIMORADA ---
     final_message = ""
@@ -106,4 +164,13 @@ async def send_access_links(bot: Bot, user_id: int, payment_id: str, is_support_
 
     await bot.send_message(chat_id=user_id, text=final_message, parse_mode=ParseMode.MARKDOWN)
 
-    logger.info(f"✅ [JOB][{payment_id}] Tarefa de links para o usuário {user_id} concluída. Gerados: {new_links_generated}, Já membro: {len(group_ids) - new_links_generated - failed_links}, Falhas: {failed_links}")
+    total_seconds = round(time.perf_counter() - started, 3)
+    timings = ", ".join(f"{r['chat_id']}={r['seconds']}s" for r in group_results)
+    logger.info(f"✅ [JOB][{payment_id}] Tarefa de links para o usuário {user_id} concluída em {total_seconds}s. Gerados: {new_links_generated}, Já membro: {already_member}, Falhas: {failed_links} (por grupo: {timings})")
+    return {
+        "generated": new_links_generated,
+        "already_member": already_member,
+        "failed": failed_links,
+        "total_seconds": total_seconds,
+        "groups": group_results,
+    }